@@ -0,0 +1,124 @@
+"""
+DeepCache-style reuse of DiT block outputs across denoising steps.
+
+Adjacent sampling steps barely change what the deeper blocks add to the token
+stream. BlockCache stores the residual that a range of blocks contributed at
+a refresh step. Until the next refresh, DiT.forward adds the stored residual
+and skips those blocks, and only the blocks outside the range are recomputed.
+compare_block_cache() measures the drift this causes against full recomputation.
+"""
+from time import time
+
+import torch
+
+
+class BlockCache:
+    """
+    Cache of the residual x_end - x_start added by DiT blocks [start, end), passed to DiT.forward
+    (or forward_with_cfg) as block_cache, e.g. through the model_kwargs of a sampling loop.
+    Every model call counts as one step. The range is recomputed on every refresh_every-th step and
+    on the steps in refresh_steps, and reused on all others.
+    :param start: the first cached block.
+    :param end: one past the last cached block.
+    :param refresh_every: the number of steps between refreshes, 1 disables reuse.
+    :param refresh_steps: steps that always refresh, e.g. the last few steps of a schedule.
+    """
+
+    def __init__(self, start, end, refresh_every=2, refresh_steps=()):
+        assert 0 <= start < end, "the cached block range must not be empty"
+        assert refresh_every >= 1
+        self.start = start
+        self.end = end
+        self.refresh_every = refresh_every
+        self.refresh_steps = set(refresh_steps)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the cached residual, call before sampling a new batch.
+        """
+        self.residual = None
+        self.num_steps = 0
+        self.num_reused = 0
+
+    def begin_step(self, x):
+        """
+        Count a model call with input x to the cached range and decide whether the cached residual is reused.
+        :return: True to reuse self.residual, False to recompute the range and store its residual.
+        """
+        step = self.num_steps
+        self.num_steps += 1
+        reuse = (
+            self.residual is not None
+            and self.residual.shape == x.shape
+            and step % self.refresh_every != 0
+            and step not in self.refresh_steps
+        )
+        self.num_reused += reuse
+        return reuse
+
+    @property
+    def reused_fraction(self):
+        return self.num_reused / max(self.num_steps, 1)
+
+
+@torch.no_grad()
+def compare_block_cache(diffusion, model, shape, block_cache, model_kwargs=None, noise=None, device=None,
+                        loop="ddim_sample_loop_progressive"):
+    """
+    Sample twice from the same noise, with full recomputation and with block_cache, and report the drift.
+    Both runs advance in lockstep, so only one step of each is held in memory. Use a deterministic loop
+    (DDIM or the multistep solvers): ancestral sampling draws different noise in the two runs.
+    :param diffusion: the (spaced) diffusion to sample with.
+    :param model: the model, e.g. a DiT or its forward_with_cfg.
+    :param shape: the shape of the samples.
+    :param block_cache: the BlockCache to evaluate, it is reset first.
+    :param model_kwargs: the model_kwargs of the sampling loop, without block_cache.
+    :param loop: the name of the progressive sampling loop of diffusion to use.
+    :return: a dict with the following keys:
+             - step_drift: per step, ||x_cached - x_full|| / ||x_full|| of the samples.
+             - final_drift: step_drift of the final samples.
+             - final_mse: the MSE between the final samples.
+             - reused_fraction: the fraction of model calls that reused the cache.
+             - time_full / time_cached: the seconds spent in each run.
+    """
+    module = getattr(model, "__self__", model)
+    device = torch.device(device) if device is not None else next(module.parameters()).device
+    if noise is None:
+        noise = torch.randn(*shape, device=device)
+    model_kwargs = dict(model_kwargs or {})
+    block_cache.reset()
+    sample_loop = getattr(diffusion, loop)
+    full = sample_loop(model, shape, noise=noise.clone(), model_kwargs=model_kwargs, device=device)
+    cached = sample_loop(model, shape, noise=noise.clone(), model_kwargs=dict(model_kwargs, block_cache=block_cache),
+                         device=device)
+
+    def timed_next(iterator):
+        start = time()
+        out = next(iterator, None)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return out, time() - start
+
+    step_drift, time_full, time_cached = [], 0.0, 0.0
+    out_full = out_cached = None
+    while True:
+        next_full, dt_full = timed_next(full)
+        next_cached, dt_cached = timed_next(cached)
+        if next_full is None or next_cached is None:
+            break
+        out_full, out_cached = next_full, next_cached
+        time_full += dt_full
+        time_cached += dt_cached
+        a, b = out_full["sample"].float(), out_cached["sample"].float()
+        step_drift.append(((b - a).norm() / a.norm().clamp_min(1e-12)).item())
+
+    a, b = out_full["sample"].float(), out_cached["sample"].float()
+    return {
+        "step_drift": step_drift,
+        "final_drift": step_drift[-1],
+        "final_mse": ((b - a) ** 2).mean().item(),
+        "reused_fraction": block_cache.reused_fraction,
+        "time_full": time_full,
+        "time_cached": time_cached,
+    }
@@ -0,0 +1,276 @@
+"""
+Asynchronous, sharded, crash-safe training checkpoints.
+
+AsyncCheckpointer.save() copies the state to pinned host memory and returns.
+A background thread writes it while training continues. Every rank writes one
+shard into <checkpoint_dir>/<step>.tmp/. Replicated (DDP) state is split over
+the ranks by size. Rank-local (FSDP) state is written whole by its own rank.
+Once all shards are written, rank 0 adds a manifest.json and renames the
+directory to <checkpoint_dir>/<step>/. The rename marks the checkpoint as
+complete, so a crash mid-write never leaves a checkpoint that looks finished.
+The ranks must share the checkpoint directory, e.g. on a network filesystem.
+"""
+import json
+import os
+import random
+import re
+import shutil
+import threading
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+MANIFEST = "manifest.json"
+
+
+def _flatten(state, path=()):
+    """
+    Split a nested structure of dicts and lists into a skeleton with the leaves replaced by None, and a
+    dict of leaves keyed by their path. Tuples are leaves, e.g. the Python and NumPy RNG states.
+    """
+    if isinstance(state, dict):
+        pairs = [(k, _flatten(v, path + (k,))) for k, v in state.items()]
+        return {k: s for k, (s, _) in pairs}, {p: l for _, (_, leaves) in pairs for p, l in leaves.items()}
+    if isinstance(state, list):
+        pairs = [_flatten(v, path + (i,)) for i, v in enumerate(state)]
+        return [s for s, _ in pairs], {p: l for _, leaves in pairs for p, l in leaves.items()}
+    return None, {path: state}
+
+
+def _unflatten(skeleton, leaves, path=()):
+    if isinstance(skeleton, dict):
+        return {k: _unflatten(v, leaves, path + (k,)) for k, v in skeleton.items()}
+    if isinstance(skeleton, list):
+        return [_unflatten(v, leaves, path + (i,)) for i, v in enumerate(skeleton)]
+    return leaves[path]
+
+
+def _assign_leaves(leaves, world_size):
+    """
+    Deterministically assign the leaves of replicated state to ranks, balancing the tensor bytes.
+    Non-tensor leaves go to rank 0.
+    """
+    owners, load = {}, [0] * world_size
+    tensors = sorted((p for p, l in leaves.items() if torch.is_tensor(l)),
+                     key=lambda p: leaves[p].numel() * leaves[p].element_size(), reverse=True)
+    for path in tensors:
+        rank = min(range(world_size), key=load.__getitem__)
+        owners[path] = rank
+        load[rank] += leaves[path].numel() * leaves[path].element_size()
+    for path in leaves:
+        owners.setdefault(path, 0)
+    return owners
+
+
+def _atomic_write(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _load_shard(path, map_location):
+    # shards hold pickled non-tensor leaves (the argparse Namespace, RNG state tuples and NumPy arrays),
+    # which the weights_only default of torch >= 2.6 refuses to load
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def rng_state():
+    """
+    The states of the Python, NumPy, torch and (current device's) CUDA random number generators.
+    """
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    """
+    Restore the random number generators from rng_state().
+    """
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None:
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def list_checkpoints(checkpoint_dir):
+    """
+    The complete checkpoints in checkpoint_dir as (step, path) tuples, oldest first.
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(checkpoint_dir):
+        path = os.path.join(checkpoint_dir, name)
+        if re.fullmatch(r"\d+", name) and os.path.isfile(os.path.join(path, MANIFEST)):
+            checkpoints.append((int(name), path))
+    return sorted(checkpoints)
+
+
+def latest_checkpoint(checkpoint_dir):
+    """
+    The path of the newest complete checkpoint in checkpoint_dir, or None.
+    """
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1][1] if checkpoints else None
+
+
+def resolve_checkpoint(path):
+    """
+    A checkpoint written by AsyncCheckpointer, or the newest complete one in a directory of them.
+    """
+    if os.path.isfile(os.path.join(path, MANIFEST)):
+        return path
+    checkpoint = latest_checkpoint(path)
+    assert checkpoint is not None, f"no complete checkpoint in {path}"
+    return checkpoint
+
+
+def load_checkpoint(path, rank=None, map_location="cpu", require_replicated=False):
+    """
+    Load a checkpoint written by AsyncCheckpointer.
+    Replicated state is merged from all shards. Rank-local state is read from the shard of `rank`,
+    which defaults to the current rank and must be passed without torch.distributed.
+    If require_replicated, fail on rank-local state, e.g. where a full model state dict is expected.
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    assert manifest["replicated"] or not require_replicated, \
+        f"{path} holds rank-local (FSDP) shards, not the full replicated state"
+    if manifest["replicated"]:
+        shards = [_load_shard(os.path.join(path, name), map_location) for name in manifest["shards"]]
+        leaves = {p: l for shard in shards for p, l in shard["leaves"].items()}
+        return _unflatten(shards[0]["skeleton"], leaves)
+    if rank is None:
+        rank = dist.get_rank()
+        assert manifest["world_size"] == dist.get_world_size(), \
+            f"the checkpoint was sharded over {manifest['world_size']} ranks, not {dist.get_world_size()}"
+    shard = _load_shard(os.path.join(path, manifest["shards"][rank]), map_location)
+    return _unflatten(shard["skeleton"], shard["leaves"])
+
+
+class AsyncCheckpointer:
+    """
+    Writes training checkpoints in a background thread, see the module docstring for the layout.
+    Must be created and used on all ranks alike.
+    :param checkpoint_dir: the directory holding one subdirectory per checkpoint.
+    :param keep_last: if specified, the number of newest checkpoints to keep, older ones are deleted.
+    """
+
+    def __init__(self, checkpoint_dir, keep_last=None):
+        assert keep_last is None or keep_last >= 1
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.distributed = dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        # the writer threads synchronize on their own gloo group, independent of the training collectives
+        self._group = dist.new_group(backend="gloo") if self.distributed else None
+        self._pinned = {}
+        self._thread = None
+        self._error = None
+
+    def save(self, step, state, replicated=True):
+        """
+        Snapshot state and write it in the background. Waits for the previous checkpoint first.
+        The GPU work queued so far is snapshotted, so state may be modified right after this returns.
+        :param step: the training step, names the checkpoint directory.
+        :param state: a nested structure of dicts and lists with tensors and picklable leaves.
+        :param replicated: True if state is the same on all ranks (DDP), False if every rank holds its
+                           own part of it (FSDP shards).
+        """
+        self.wait()
+        skeleton, leaves = _flatten(state)
+        if replicated:
+            owners = _assign_leaves(leaves, self.world_size)
+            leaves = {p: l for p, l in leaves.items() if owners[p] == self.rank}
+        leaves = {p: self._snapshot(p, l) for p, l in leaves.items()}
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()
+        payload = {"skeleton": skeleton, "leaves": leaves}
+        self._thread = threading.Thread(target=self._write, args=(step, payload, event, replicated))
+        self._thread.start()
+
+    def wait(self):
+        """
+        Wait for the checkpoint being written, and raise any error of the writer.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self._pinned.clear()
+
+    def _snapshot(self, path, leaf):
+        if not torch.is_tensor(leaf):
+            return leaf
+        leaf = leaf.detach()
+        if not leaf.is_cuda:
+            return leaf.clone()
+        # pinned buffers are reused by the next checkpoint, which waits for this one to be written
+        buffer = self._pinned.get(path)
+        if buffer is None or buffer.shape != leaf.shape or buffer.dtype != leaf.dtype:
+            buffer = torch.empty(leaf.shape, dtype=leaf.dtype, pin_memory=True)
+            self._pinned[path] = buffer
+        return buffer.copy_(leaf, non_blocking=True)
+
+    def _write(self, step, payload, event, replicated):
+        tmp_dir = os.path.join(self.checkpoint_dir, f"{step:07d}.tmp")
+        try:
+            if event is not None:
+                event.synchronize()
+            os.makedirs(tmp_dir, exist_ok=True)
+            shard = f"rank{self.rank:05d}.pt"
+            _atomic_write(os.path.join(tmp_dir, shard), lambda f: torch.save(payload, f))
+        except Exception as e:
+            self._error = e
+        try:
+            # every rank reaches this collective, also after a failed write, so all ranks fail together
+            # instead of the others waiting forever for the failed one
+            if not self._all_ranks_succeeded(self._error is None):
+                if self._error is None:
+                    self._error = RuntimeError(f"writing checkpoint {step} failed on another rank")
+                return
+            if self.rank == 0:
+                manifest = {
+                    "step": step,
+                    "world_size": self.world_size,
+                    "replicated": replicated,
+                    "shards": [f"rank{r:05d}.pt" for r in range(self.world_size)],
+                }
+                _atomic_write(os.path.join(tmp_dir, MANIFEST), lambda f: f.write(json.dumps(manifest).encode()))
+                final_dir = os.path.join(self.checkpoint_dir, f"{step:07d}")
+                if os.path.exists(final_dir):
+                    shutil.rmtree(final_dir)
+                os.replace(tmp_dir, final_dir)
+                self._prune()
+        except Exception as e:
+            self._error = self._error or e
+
+    def _all_ranks_succeeded(self, success):
+        if not self.distributed:
+            return success
+        flag = torch.tensor([int(success)])
+        dist.all_reduce(flag, op=dist.ReduceOp.MIN, group=self._group)
+        return bool(flag.item())
+
+    def _prune(self):
+        if self.keep_last is None:
+            return
+        for _, path in list_checkpoints(self.checkpoint_dir)[:-self.keep_last]:
+            shutil.rmtree(path, ignore_errors=True)
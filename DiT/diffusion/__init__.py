@@ -5,6 +5,7 @@
 
 from . import gaussian_diffusion as gd
 from .respace import SpacedDiffusion, space_timesteps
+from .sampling_engine import SamplingEngine, SamplingRequest
 
 
 def create_diffusion(
@@ -44,3 +45,20 @@ def create_diffusion(
         loss_type=loss_type
         # rescale_timesteps=rescale_timesteps,
     )
+
+
+_diffusion_cache = {}
+
+
+def get_diffusion(timestep_respacing, **kwargs):
+    """
+    Same as create_diffusion(), but every diffusion is built once per set of
+    arguments and then shared, so switching respacings is a dict lookup.
+    The returned objects are shared and must not be modified.
+    """
+    if timestep_respacing is not None and not isinstance(timestep_respacing, str):
+        timestep_respacing = tuple(timestep_respacing)
+    key = (timestep_respacing, tuple(sorted(kwargs.items())))
+    if key not in _diffusion_cache:
+        _diffusion_cache[key] = create_diffusion(timestep_respacing, **kwargs)
+    return _diffusion_cache[key]
@@ -200,6 +200,54 @@ class GaussianDiffusion:
             (1.0 - self.alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - self.alphas_cumprod)
         )
 
+        # device-resident copies of the arrays above, see _schedule_tensors()
+        self._schedule_cache = {}
+
+    def _schedule_tensors(self, device, dtype=th.float32):
+        """
+        Get the per-timestep schedule arrays as tensors on a device.
+        They are copied in a single transfer the first time a device/dtype is
+        used and reused afterwards, so sampling and training steps only index.
+        :return: a dict from array name to a 1-D tensor.
+        """
+        key = (th.device(device), dtype)
+        if key not in self._schedule_cache:
+            arrays = {
+                name: getattr(self, name)
+                for name in (
+                    "betas",
+                    "alphas_cumprod",
+                    "alphas_cumprod_prev",
+                    "alphas_cumprod_next",
+                    "sqrt_alphas_cumprod",
+                    "sqrt_one_minus_alphas_cumprod",
+                    "log_one_minus_alphas_cumprod",
+                    "sqrt_recip_alphas_cumprod",
+                    "sqrt_recipm1_alphas_cumprod",
+                    "posterior_variance",
+                    "posterior_log_variance_clipped",
+                    "posterior_mean_coef1",
+                    "posterior_mean_coef2",
+                )
+            }
+            arrays["one_minus_alphas_cumprod"] = 1.0 - self.alphas_cumprod
+            arrays["log_betas"] = np.log(self.betas)
+            # for fixedlarge, we set the initial (log-)variance like so
+            # to get a better decoder log likelihood.
+            arrays["fixed_large_variance"] = np.append(self.posterior_variance[1], self.betas[1:])
+            arrays["fixed_large_log_variance"] = np.log(arrays["fixed_large_variance"])
+            # posterior_log_variance_clipped is empty for a single-step process
+            arrays = {k: v for k, v in arrays.items() if len(v) == self.num_timesteps}
+            table = th.from_numpy(np.stack(list(arrays.values()))).to(device=device, dtype=dtype)
+            self._schedule_cache[key] = dict(zip(arrays, table))
+        return self._schedule_cache[key]
+
+    def _extract(self, name, t, broadcast_shape):
+        """
+        Like _extract_into_tensor(), but indexes the device-resident schedule array of the given name.
+        """
+        return _extract_into_tensor(self._schedule_tensors(t.device)[name], t, broadcast_shape)
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -207,9 +255,9 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(self.log_one_minus_alphas_cumprod, t, x_start.shape)
+        mean = self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+        variance = self._extract("one_minus_alphas_cumprod", t, x_start.shape).expand(x_start.shape)
+        log_variance = self._extract("log_one_minus_alphas_cumprod", t, x_start.shape).expand(x_start.shape)
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, noise=None):
@@ -225,8 +273,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape) * noise
         )
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
@@ -236,13 +284,13 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape).expand(x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
+        ).expand(x_t.shape)
         assert (
             posterior_mean.shape[0]
             == posterior_variance.shape[0]
@@ -285,27 +333,19 @@ class GaussianDiffusion:
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
             model_output, model_var_values = th.split(model_output, C, dim=1)
-            min_log = _extract_into_tensor(self.posterior_log_variance_clipped, t, x.shape)
-            max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+            min_log = self._extract("posterior_log_variance_clipped", t, x.shape)
+            max_log = self._extract("log_betas", t, x.shape)
             # The model_var_values is [-1, 1] for [min_var, max_var].
             frac = (model_var_values + 1) / 2
             model_log_variance = frac * max_log + (1 - frac) * min_log
             model_variance = th.exp(model_log_variance)
         else:
             model_variance, model_log_variance = {
-                # for fixedlarge, we set the initial (log-)variance like so
-                # to get a better decoder log likelihood.
-                ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
-                ),
-                ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
-                ),
+                ModelVarType.FIXED_LARGE: ("fixed_large_variance", "fixed_large_log_variance"),
+                ModelVarType.FIXED_SMALL: ("posterior_variance", "posterior_log_variance_clipped"),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape).expand(x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape).expand(x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -334,14 +374,14 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t - pred_xstart
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def condition_mean(self, cond_fn, p_mean_var, x, t, model_kwargs=None):
         """
@@ -363,7 +403,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(x, t, **model_kwargs)
@@ -540,8 +580,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -587,10 +627,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = out["pred_xstart"] * th.sqrt(alpha_bar_next) + th.sqrt(1 - alpha_bar_next) * eps
@@ -679,6 +719,200 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def multistep_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        solver="dpmsolver++",
+        order=2,
+    ):
+        """
+        Generate samples from the model using a multistep ODE solver.
+        These reach DDIM quality in far fewer steps, so use them with a process
+        respaced to 10-25 timesteps. Each timestep costs one model evaluation.
+        Same usage as p_sample_loop(), plus:
+        :param solver: "dpmsolver++" for DPM-Solver++(2M/3M) (Lu et al., 2022)
+                       or "unipc" for UniPC-bh2 (Zhao et al., 2023).
+        :param order: the solver order, 1 to 3; 2 or 3 recommended. Lower
+                      orders are used for the first and last steps.
+        """
+        final = None
+        for sample in self.multistep_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            solver=solver,
+            order=order,
+        ):
+            final = sample
+        return final["sample"]
+
+    def multistep_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        solver="dpmsolver++",
+        order=2,
+    ):
+        """
+        Use a multistep solver to sample from the model and yield intermediate
+        samples from each timestep.
+        Same usage as multistep_sample_loop() and p_sample_loop_progressive().
+        """
+        assert solver in ("dpmsolver++", "unipc"), f"unknown solver {solver}"
+        assert 1 <= order <= 3
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        indices = list(range(self.num_timesteps))[::-1]
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        # the x_0 predictions and timesteps of the last `order` steps, oldest first
+        x0_preds, x0_steps = [], []
+        prev_img, prev_order = None, None
+        for i in indices:
+            t = th.tensor([i] * shape[0], device=device)
+            with th.no_grad():
+                out = self.p_mean_variance(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                )
+                if cond_fn is not None:
+                    out = self.condition_score(cond_fn, out, img, t, model_kwargs=model_kwargs)
+                x0 = out["pred_xstart"]
+                if solver == "unipc" and prev_img is not None and i > 0:
+                    # UniC: correct the current point with the model output at it, for free
+                    img = self._unipc_update(
+                        prev_img, x0_preds[-prev_order:], x0_steps[-prev_order:], i, x0_t=x0
+                    )
+                x0_preds, x0_steps = (x0_preds + [x0])[-order:], (x0_steps + [i])[-order:]
+
+                if i == 0:
+                    sample = x0
+                else:
+                    prev_order = min(order, len(x0_preds), i)
+                    update = self._dpm_solver_pp_update if solver == "dpmsolver++" else self._unipc_update
+                    sample = update(img, x0_preds[-prev_order:], x0_steps[-prev_order:], i - 1)
+                yield {"sample": sample, "pred_xstart": x0}
+                prev_img, img = img, sample
+
+    def _solver_coefficients(self, t):
+        """
+        Get alpha_t, sigma_t and the half-log-SNR lambda_t of the VP
+        process at timestep t, as Python floats.
+        """
+        alpha = math.sqrt(self.alphas_cumprod[t])
+        sigma = math.sqrt(1.0 - self.alphas_cumprod[t])
+        return alpha, sigma, math.log(alpha) - math.log(sigma)
+
+    def _dpm_solver_pp_update(self, x, x0_preds, x0_steps, t):
+        """
+        One DPM-Solver++ step from x at x0_steps[-1] to timestep t, of order
+        len(x0_preds) (1 to 3), given the x_0 predictions at x0_steps.
+        """
+        alpha_t, sigma_t, lambda_t = self._solver_coefficients(t)
+        _, sigma_s0, lambda_s0 = self._solver_coefficients(x0_steps[-1])
+        h = lambda_t - lambda_s0
+        phi_1 = math.expm1(-h)
+        m0 = x0_preds[-1]
+        x_t = (sigma_t / sigma_s0) * x - (alpha_t * phi_1) * m0
+        if len(x0_preds) == 1:
+            return x_t
+        lambda_s1 = self._solver_coefficients(x0_steps[-2])[2]
+        r0 = (lambda_s0 - lambda_s1) / h
+        d1_0 = (m0 - x0_preds[-2]) / r0
+        if len(x0_preds) == 2:
+            return x_t - (0.5 * alpha_t * phi_1) * d1_0
+        lambda_s2 = self._solver_coefficients(x0_steps[-3])[2]
+        r1 = (lambda_s1 - lambda_s2) / h
+        d1_1 = (x0_preds[-2] - x0_preds[-3]) / r1
+        d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+        d2 = (d1_0 - d1_1) / (r0 + r1)
+        return (
+            x_t
+            + (alpha_t * (phi_1 / h + 1.0)) * d1
+            - (alpha_t * ((phi_1 + h) / h ** 2 - 0.5)) * d2
+        )
+
+    def _unipc_update(self, x, x0_preds, x0_steps, t, x0_t=None):
+        """
+        One UniPC-bh2 step from x at x0_steps[-1] to timestep t, of order
+        len(x0_preds), given the x_0 predictions at x0_steps.
+        Without x0_t this is the predictor (UniP); given the x_0 prediction at
+        t, it is the corrector (UniC) that refines the predicted x_t.
+        """
+        alpha_t, sigma_t, lambda_t = self._solver_coefficients(t)
+        _, sigma_s0, lambda_s0 = self._solver_coefficients(x0_steps[-1])
+        h = lambda_t - lambda_s0
+        order = len(x0_preds)
+        m0 = x0_preds[-1]
+
+        rks, d1s = [], []
+        for k in range(2, order + 1):
+            rk = (self._solver_coefficients(x0_steps[-k])[2] - lambda_s0) / h
+            rks.append(rk)
+            d1s.append((x0_preds[-k] - m0) / rk)
+        rks = np.array(rks + [1.0])
+
+        hh = -h
+        h_phi_1 = math.expm1(hh)
+        h_phi_k = h_phi_1 / hh - 1
+        b_h = math.expm1(hh)
+        factorial_i = 1
+        R, b = [], []
+        for i in range(1, order + 1):
+            R.append(rks ** (i - 1))
+            b.append(h_phi_k * factorial_i / b_h)
+            factorial_i *= i + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial_i
+        R, b = np.stack(R), np.array(b)
+
+        x_t = (sigma_t / sigma_s0) * x - (alpha_t * h_phi_1) * m0
+        if x0_t is None:
+            if order == 1:
+                return x_t
+            rhos = [0.5] if order == 2 else np.linalg.solve(R[:-1, :-1], b[:-1])
+            res = sum(float(rho) * d1 for rho, d1 in zip(rhos, d1s))
+        else:
+            rhos = [0.5] if order == 1 else np.linalg.solve(R, b)
+            res = float(rhos[-1]) * (x0_t - m0)
+            for rho, d1 in zip(rhos[:-1], d1s):
+                res = res + float(rho) * d1
+        return x_t - (alpha_t * b_h) * res
+
     def _vb_terms_bpd(
             self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
@@ -857,17 +1091,119 @@ class GaussianDiffusion:
             "mse": mse,
         }
 
+    def calc_bpd_loop_batched(
+        self,
+        model,
+        x_start,
+        clip_denoised=True,
+        model_kwargs=None,
+        timesteps_per_batch=8,
+        num_strata=None,
+        generator=None,
+    ):
+        """
+        A memory-bounded variant of calc_bpd_loop(). Several timesteps are
+        evaluated per model call by stacking them along the batch dimension,
+        and the statistics are accumulated on the fly instead of keeping
+        [N x T] tensors of every term.
+        :param model: the model to evaluate loss on.
+        :param x_start: the [N x C x ...] tensor of inputs.
+        :param clip_denoised: if True, clip denoised samples.
+        :param model_kwargs: if not None, a dict of extra keyword arguments to
+            pass to the model. Tensors with a leading batch dimension of N are
+            repeated along with x_start.
+        :param timesteps_per_batch: the number of timesteps per model call, so
+                                    the model sees timesteps_per_batch * N samples.
+        :param num_strata: if specified, estimate the sums over all timesteps
+                           from one random timestep in each of num_strata
+                           equally sized strata, weighted by the stratum sizes.
+        :param generator: if specified, the th.Generator for the stratified timesteps.
+        :return: a dict containing the following keys, all [N] tensors:
+                 - total_bpd: the total variational lower-bound, per batch element.
+                 - prior_bpd: the prior term in the lower-bound.
+                 - vb: the sum of the lower-bound terms over all timesteps.
+                 - xstart_mse: the x_0 MSE, averaged over timesteps.
+                 - mse: the epsilon MSE, averaged over timesteps.
+        """
+        device = x_start.device
+        batch_size = x_start.shape[0]
+        if model_kwargs is None:
+            model_kwargs = {}
+
+        if num_strata is None:
+            timesteps = th.arange(self.num_timesteps)
+            weights = th.ones(self.num_timesteps)
+        else:
+            num_strata = min(num_strata, self.num_timesteps)
+            bounds = th.linspace(0, self.num_timesteps, num_strata + 1).round().long()
+            sizes = bounds[1:] - bounds[:-1]
+            offsets = (th.rand(num_strata, generator=generator) * sizes).long()
+            timesteps = bounds[:-1] + offsets
+            weights = sizes.float()
+        timesteps, weights = timesteps.to(device), weights.to(device)
+
+        vb = th.zeros(batch_size, device=device)
+        xstart_mse = th.zeros(batch_size, device=device)
+        mse = th.zeros(batch_size, device=device)
+        for chunk_t, chunk_w in zip(
+            timesteps.split(timesteps_per_batch), weights.split(timesteps_per_batch)
+        ):
+            k = len(chunk_t)
+            t_batch = chunk_t.repeat_interleave(batch_size)
+            x_rep = _repeat_batch(x_start, k, batch_size)
+            kwargs = {key: _repeat_batch(value, k, batch_size) for key, value in model_kwargs.items()}
+            with th.no_grad():
+                noise = th.randn_like(x_rep)
+                x_t = self.q_sample(x_start=x_rep, t=t_batch, noise=noise)
+                out = self._vb_terms_bpd(
+                    model,
+                    x_start=x_rep,
+                    x_t=x_t,
+                    t=t_batch,
+                    clip_denoised=clip_denoised,
+                    model_kwargs=kwargs,
+                )
+                eps = self._predict_eps_from_xstart(x_t, t_batch, out["pred_xstart"])
+                w = chunk_w.view(k, 1)
+                vb += (out["output"].view(k, batch_size) * w).sum(dim=0)
+                xstart_mse += (
+                    mean_flat((out["pred_xstart"] - x_rep) ** 2).view(k, batch_size) * w
+                ).sum(dim=0)
+                mse += (mean_flat((eps - noise) ** 2).view(k, batch_size) * w).sum(dim=0)
+
+        prior_bpd = self._prior_bpd(x_start)
+        total_bpd = vb + prior_bpd
+        return {
+            "total_bpd": total_bpd,
+            "prior_bpd": prior_bpd,
+            "vb": vb,
+            "xstart_mse": xstart_mse / self.num_timesteps,
+            "mse": mse / self.num_timesteps,
+        }
+
+
+def _repeat_batch(value, repeats, batch_size):
+    """
+    Repeat a tensor with a leading batch dimension of batch_size along that
+    dimension; other values are returned as is.
+    """
+    if not th.is_tensor(value) or value.ndim == 0 or value.shape[0] != batch_size:
+        return value
+    return value.repeat(repeats, *([1] * (value.ndim - 1)))
+
 
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
-    Extract values from a 1-D numpy array for a batch of indices.
-    :param arr: the 1-D numpy array.
+    Extract values from a 1-D numpy array or tensor for a batch of indices.
+    :param arr: the 1-D numpy array, or a 1-D tensor on the device of timesteps.
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
-    :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
+    :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims,
+             which broadcasts against broadcast_shape; use .expand() where a
+             full-shape view is needed, nothing is materialized.
     """
-    res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
-    while len(res.shape) < len(broadcast_shape):
-        res = res[..., None]
-    return res + th.zeros(broadcast_shape, device=timesteps.device)
+    if isinstance(arr, np.ndarray):
+        arr = th.from_numpy(arr).to(device=timesteps.device)
+    res = arr[timesteps].float()
+    return res.view(-1, *([1] * (len(broadcast_shape) - 1)))
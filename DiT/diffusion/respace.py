@@ -3,8 +3,11 @@
 #     ADM:   https://github.com/openai/guided-diffusion/blob/main/guided_diffusion
 #     IDDPM: https://github.com/openai/improved-diffusion/blob/main/improved_diffusion/gaussian_diffusion.py
 
+import inspect
+
 import numpy as np
 import torch as th
+import torch.distributed as dist
 
 from .gaussian_diffusion import GaussianDiffusion
 
@@ -31,11 +34,13 @@ def space_timesteps(num_timesteps, section_counts):
     if isinstance(section_counts, str):
         if section_counts.startswith("ddim"):
             desired_count = int(section_counts[len("ddim") :])
-            for i in range(1, num_timesteps):
-                if len(range(0, num_timesteps, i)) == desired_count:
-                    return set(range(0, num_timesteps, i))
+            # the smallest stride i with len(range(0, num_timesteps, i)) == desired_count
+            if desired_count >= 1:
+                stride = -(-num_timesteps // desired_count)
+                if stride < num_timesteps and -(-num_timesteps // stride) == desired_count:
+                    return set(range(0, num_timesteps, stride))
             raise ValueError(
-                f"cannot create exactly {num_timesteps} steps with an integer stride"
+                f"cannot create exactly {desired_count} steps with an integer stride"
             )
         section_counts = [int(x) for x in section_counts.split(",")]
     size_per = num_timesteps // len(section_counts)
@@ -72,18 +77,15 @@ class SpacedDiffusion(GaussianDiffusion):
 
     def __init__(self, use_timesteps, **kwargs):
         self.use_timesteps = set(use_timesteps)
-        self.timestep_map = []
         self.original_num_steps = len(kwargs["betas"])
-
-        base_diffusion = GaussianDiffusion(**kwargs)  # pylint: disable=missing-kwoa
-        last_alpha_cumprod = 1.0
-        new_betas = []
-        for i, alpha_cumprod in enumerate(base_diffusion.alphas_cumprod):
-            if i in self.use_timesteps:
-                new_betas.append(1 - alpha_cumprod / last_alpha_cumprod)
-                last_alpha_cumprod = alpha_cumprod
-                self.timestep_map.append(i)
-        kwargs["betas"] = np.array(new_betas)
+        timesteps = np.array(sorted(t for t in self.use_timesteps if 0 <= t < self.original_num_steps), dtype=np.int64)
+        self.timestep_map = timesteps.tolist()
+        # per-device copies of timestep_map, shared by all wrapped models, see _WrappedModel
+        self._timestep_map_tensors = {}
+
+        # the betas of the retained steps, so they keep the alphas_cumprod of the base process
+        alphas_cumprod = np.cumprod(1.0 - np.array(kwargs["betas"], dtype=np.float64))[timesteps]
+        kwargs["betas"] = 1 - alphas_cumprod / np.append(1.0, alphas_cumprod[:-1])
         super().__init__(**kwargs)
 
     def p_mean_variance(
@@ -102,11 +104,72 @@ class SpacedDiffusion(GaussianDiffusion):
     def condition_score(self, cond_fn, *args, **kwargs):
         return super().condition_score(self._wrap_model(cond_fn), *args, **kwargs)
 
+    def p_sample_loop_progressive(self, model, *args, **kwargs):
+        return self._sample_loop(super().p_sample_loop_progressive, model, *args, **kwargs)
+
+    def ddim_sample_loop_progressive(self, model, *args, **kwargs):
+        return self._sample_loop(super().ddim_sample_loop_progressive, model, *args, **kwargs)
+
+    def multistep_sample_loop_progressive(self, model, *args, **kwargs):
+        return self._sample_loop(super().multistep_sample_loop_progressive, model, *args, **kwargs)
+
+    def _sample_loop(self, loop, model, *args, **kwargs):
+        """
+        Run a progressive sampling loop of the base process with the conditioning of the model cached,
+        see _cache_conditioning(), and in lockstep across a sequence-parallel group, see
+        _sync_sequence_parallel(). The arguments are bound to the signature of loop, so they may be
+        passed positionally or by name.
+        """
+        arguments = inspect.signature(loop).bind(model, *args, **kwargs)
+        arguments.arguments["model_kwargs"] = self._cache_conditioning(
+            model, arguments.arguments.get("model_kwargs")
+        )
+        self._sync_sequence_parallel(model, arguments)
+        for out in loop(*arguments.args, **arguments.kwargs):
+            self._sync_sequence_parallel(model, out=out)
+            yield out
+
+    def _sync_sequence_parallel(self, model, arguments=None, out=None):
+        """
+        For a model in sequence-parallel mode (DiT.enable_sequence_parallel), all ranks must denoise
+        identical inputs: the initial noise of the loop arguments and every step's sample in out are
+        broadcast in place from the first rank of the group, so ranks with different random states
+        stay in lockstep. Does nothing for other models.
+        """
+        module = getattr(model, "__self__", model)
+        group = getattr(module, "sp_group", None)
+        if group is None:
+            return
+        src = dist.get_global_rank(group, 0) if group is not dist.group.WORLD else 0
+        if arguments is not None:
+            if arguments.arguments.get("noise") is None:
+                device = arguments.arguments.get("device") or next(module.parameters()).device
+                arguments.arguments["noise"] = th.randn(*arguments.arguments["shape"], device=device)
+            dist.broadcast(arguments.arguments["noise"], src, group=group)
+        if out is not None:
+            # in place, the loop continues from this tensor
+            dist.broadcast(out["sample"], src, group=group)
+
+    def _cache_conditioning(self, model, model_kwargs):
+        """
+        If the model (or the module a bound method like forward_with_cfg belongs to) can cache its
+        conditioning (DiT.conditioning_cache), precompute it once for every retained timestep and the
+        labels y of model_kwargs, so the sampling steps skip the timestep and label embedders.
+        """
+        if model_kwargs is None or "y" not in model_kwargs or "cond_cache" in model_kwargs:
+            return model_kwargs
+        module = getattr(model, "__self__", model)
+        if not hasattr(module, "conditioning_cache"):
+            return model_kwargs
+        # the wrapped model is called with the original timesteps, see _WrappedModel
+        cond_cache = module.conditioning_cache(self.timestep_map, model_kwargs["y"])
+        return dict(model_kwargs, cond_cache=cond_cache)
+
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.original_num_steps
+            model, self.timestep_map, self.original_num_steps, self._timestep_map_tensors
         )
 
     def _scale_timesteps(self, t):
@@ -115,15 +178,19 @@ class SpacedDiffusion(GaussianDiffusion):
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, original_num_steps):
+    def __init__(self, model, timestep_map, original_num_steps, map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         # self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # (device, dtype) -> timestep_map tensor, copied to a device only once
+        self.map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        key = (ts.device, ts.dtype)
+        if key not in self.map_tensors:
+            self.map_tensors[key] = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        new_ts = self.map_tensors[key][ts]
         # if self.rescale_timesteps:
         #     new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, **kwargs)
@@ -0,0 +1,201 @@
+"""
+Continuous-batching sampling on top of SpacedDiffusion: requests join and
+leave a running batch at any step instead of waiting for a whole batch.
+"""
+
+from collections import defaultdict, deque
+
+import torch as th
+
+
+class SamplingRequest:
+    """
+    One video to generate with a SamplingEngine.
+    :param shape: the (C, T, H, W) shape of the latent to sample.
+    :param y: the class label.
+    :param num_steps: the number of respaced diffusion steps.
+    :param cfg_scale: the classifier-free guidance scale, 1.0 disables guidance.
+    :param sampler: "ddim", or "ddpm" for ancestral sampling.
+    :param eta: the DDIM eta.
+    :param noise: if specified, the initial noise, of the given shape.
+    """
+
+    def __init__(self, shape, y, num_steps=250, cfg_scale=1.0, sampler="ddim", eta=0.0, noise=None):
+        assert sampler in ("ddim", "ddpm"), f"unknown sampler {sampler}"
+        self.shape = tuple(shape)
+        self.y = int(y)
+        self.num_steps = num_steps
+        self.cfg_scale = cfg_scale
+        self.sampler = sampler
+        self.eta = eta
+        self.noise = noise
+        self.num_steps_taken = 0
+        # the current x_t while running, the final sample once done
+        self.sample = None
+        self.pred_xstart = None
+
+    @property
+    def done(self):
+        return self.num_steps_taken == self.num_steps
+
+    @property
+    def num_rows(self):
+        # guided requests also run the unconditional branch
+        return 1 if self.cfg_scale == 1.0 else 2
+
+
+class SamplingEngine:
+    """
+    Continuous-batching sampler. Requests with different labels, step counts,
+    guidance scales and samplers share a running batch, every element carries
+    its own timestep, and requests of the same latent shape share one model
+    forward per step. Finished requests leave the batch immediately and
+    pending ones take their place.
+    :param model: the model, called as model(x, t, y) with the original
+                  (unspaced) timesteps, e.g. a DiT.
+    :param max_batch_size: the maximum number of rows in flight, where a
+                           guided request takes two.
+    :param null_label: the label of the unconditional guidance branch,
+                       defaults to the model's null class.
+    :param device: the device to sample on, defaults to the model's.
+    :param clip_denoised: if True, clip x_start predictions to [-1, 1].
+    :param guided_channels: the number of leading output channels that
+                            classifier-free guidance applies to. The default
+                            of 3 matches DiT.forward_with_cfg, None guides
+                            all eps channels (the standard approach).
+    :param diffusion_kwargs: extra arguments for create_diffusion().
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size=16,
+        null_label=None,
+        device=None,
+        clip_denoised=False,
+        guided_channels=3,
+        **diffusion_kwargs,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        if null_label is None:
+            null_label = model.y_embedder.num_classes
+        self.null_label = null_label
+        if device is None:
+            device = next(model.parameters()).device
+        self.device = device
+        self.clip_denoised = clip_denoised
+        self.guided_channels = guided_channels
+        self.diffusion_kwargs = diffusion_kwargs
+        self.pending = deque()
+        self.active = []
+
+    def submit(self, request):
+        """
+        Queue a SamplingRequest, it joins the batch at the next step with room.
+        """
+        assert request.num_rows <= self.max_batch_size, "request does not fit into max_batch_size"
+        self.pending.append(request)
+        return request
+
+    def step(self):
+        """
+        Admit pending requests while there is room and advance every running
+        request by one timestep.
+        :return: a list of the requests that finished in this step.
+        """
+        self._admit()
+        buckets = defaultdict(list)
+        for request in self.active:
+            buckets[request.shape].append(request)
+        for requests in buckets.values():
+            self._step_bucket(requests)
+        finished = [r for r in self.active if r.done]
+        self.active = [r for r in self.active if not r.done]
+        return finished
+
+    def run(self):
+        """
+        Yield requests as they finish until no requests are left.
+        More requests may be submitted while iterating.
+        """
+        while self.pending or self.active:
+            yield from self.step()
+
+    def _diffusion(self, num_steps):
+        # lazy import, the package __init__ imports this module
+        from . import get_diffusion
+
+        return get_diffusion(str(num_steps), **self.diffusion_kwargs)
+
+    def _admit(self):
+        num_rows = sum(r.num_rows for r in self.active)
+        while self.pending and num_rows + self.pending[0].num_rows <= self.max_batch_size:
+            request = self.pending.popleft()
+            if request.noise is not None:
+                request.sample = request.noise.to(self.device)
+            else:
+                request.sample = th.randn(*request.shape, device=self.device)
+            self.active.append(request)
+            num_rows += request.num_rows
+
+    def _step_bucket(self, requests):
+        """
+        Advance requests of one latent shape with a single model forward.
+        """
+        n = len(requests)
+        x = th.stack([r.sample for r in requests])
+        # respaced timestep of every element, and the original one the model expects
+        indices = [r.num_steps - 1 - r.num_steps_taken for r in requests]
+        t = th.tensor(indices, device=self.device)
+        t_model = th.tensor(
+            [self._diffusion(r.num_steps).timestep_map[i] for r, i in zip(requests, indices)],
+            device=self.device,
+        )
+        y = th.tensor([r.y for r in requests], device=self.device)
+
+        guided = [k for k, r in enumerate(requests) if r.cfg_scale != 1.0]
+        if guided:
+            guided_t = th.tensor(guided, device=self.device)
+            x_in = th.cat([x, x[guided_t]])
+            t_in = th.cat([t_model, t_model[guided_t]])
+            y_in = th.cat([y, th.full((len(guided),), self.null_label, device=self.device)])
+        else:
+            x_in, t_in, y_in = x, t_model, y
+        with th.no_grad():
+            model_out = self.model(x_in, t_in, y_in)
+
+        out = model_out[:n]
+        if guided:
+            # guide (some of) the eps channels, learned variances are taken from the conditional branch
+            C = x.shape[1] if self.guided_channels is None else min(self.guided_channels, x.shape[1])
+            cond, uncond = out[guided_t, :C], model_out[n:, :C]
+            scale = th.tensor([requests[k].cfg_scale for k in guided], device=self.device, dtype=out.dtype)
+            out[guided_t, :C] = uncond + scale.view(-1, *([1] * (x.ndim - 1))) * (cond - uncond)
+
+        # requests with the same schedule and sampler share one update
+        groups = defaultdict(list)
+        for k, r in enumerate(requests):
+            groups[(r.num_steps, r.sampler, r.eta)].append(k)
+        for (num_steps, sampler, eta), group in groups.items():
+            group_t = th.tensor(group, device=self.device)
+            group_out = out[group_t]
+
+            def model_fn(*args, **kwargs):
+                return group_out
+
+            diffusion = self._diffusion(num_steps)
+            with th.no_grad():
+                if sampler == "ddim":
+                    result = diffusion.ddim_sample(
+                        model_fn, x[group_t], t[group_t], clip_denoised=self.clip_denoised, eta=eta
+                    )
+                else:
+                    result = diffusion.p_sample(
+                        model_fn, x[group_t], t[group_t], clip_denoised=self.clip_denoised
+                    )
+            for j, k in enumerate(group):
+                request = requests[k]
+                request.sample = result["sample"][j]
+                request.pred_xstart = result["pred_xstart"][j]
+                request.num_steps_taken += 1
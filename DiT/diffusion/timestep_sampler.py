@@ -58,6 +58,15 @@ class ScheduleSampler(ABC):
         weights = th.from_numpy(weights_np).float().to(device)
         return indices, weights
 
+    def state_dict(self):
+        """
+        The state of the sampler, for resuming training.
+        """
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
 
 class UniformSampler(ScheduleSampler):
     def __init__(self, diffusion):
@@ -67,6 +76,11 @@ class UniformSampler(ScheduleSampler):
     def weights(self):
         return self._weights
 
+    def sample(self, batch_size, device):
+        # sample on the device, all weights are 1
+        indices = th.randint(0, len(self._weights), (batch_size,), device=device)
+        return indices, th.ones(batch_size, device=device)
+
 
 class LossAwareSampler(ScheduleSampler):
     def update_with_local_losses(self, local_ts, local_losses):
@@ -79,28 +93,19 @@ class LossAwareSampler(ScheduleSampler):
         :param local_ts: an integer Tensor of timesteps.
         :param local_losses: a 1D Tensor of losses.
         """
-        batch_sizes = [
-            th.tensor([0], dtype=th.int32, device=local_ts.device)
-            for _ in range(dist.get_world_size())
-        ]
-        dist.all_gather(
-            batch_sizes,
-            th.tensor([len(local_ts)], dtype=th.int32, device=local_ts.device),
-        )
-
-        # Pad all_gather batches to be the maximum batch size.
-        batch_sizes = [x.item() for x in batch_sizes]
-        max_bs = max(batch_sizes)
-
-        timestep_batches = [th.zeros(max_bs).to(local_ts) for bs in batch_sizes]
-        loss_batches = [th.zeros(max_bs).to(local_losses) for bs in batch_sizes]
-        dist.all_gather(timestep_batches, local_ts)
-        dist.all_gather(loss_batches, local_losses)
-        timesteps = [
-            x.item() for y, bs in zip(timestep_batches, batch_sizes) for x in y[:bs]
-        ]
-        losses = [x.item() for y, bs in zip(loss_batches, batch_sizes) for x in y[:bs]]
-        self.update_with_all_losses(timesteps, losses)
+        # Pad every rank's batch to the largest one and gather the packed
+        # (timestep, loss, valid) rows of all ranks in a single all_gather.
+        batch_size = th.tensor(len(local_ts), device=local_ts.device)
+        dist.all_reduce(batch_size, op=dist.ReduceOp.MAX)
+        local_rows = th.zeros(int(batch_size), 3, dtype=th.float64, device=local_ts.device)
+        local_rows[: len(local_ts), 0] = local_ts.to(th.float64)
+        local_rows[: len(local_ts), 1] = local_losses.detach().to(th.float64)
+        local_rows[: len(local_ts), 2] = 1
+        rows = [th.zeros_like(local_rows) for _ in range(dist.get_world_size())]
+        dist.all_gather(rows, local_rows)
+        rows = th.cat(rows).cpu().numpy()
+        rows = rows[rows[:, 2] == 1]
+        self.update_with_all_losses(rows[:, 0].astype(np.int64), rows[:, 1])
 
     @abstractmethod
     def update_with_all_losses(self, ts, losses):
@@ -112,8 +117,8 @@ class LossAwareSampler(ScheduleSampler):
         between workers. It is called by update_with_local_losses from all
         ranks with identical arguments. Thus, it should have deterministic
         behavior to maintain state across workers.
-        :param ts: a list of int timesteps.
-        :param losses: a list of float losses, one per timestep.
+        :param ts: a list or array of int timesteps.
+        :param losses: a list or array of float losses, one per timestep.
         """
 
 
@@ -122,10 +127,11 @@ class LossSecondMomentResampler(LossAwareSampler):
         self.diffusion = diffusion
         self.history_per_term = history_per_term
         self.uniform_prob = uniform_prob
+        # a ring buffer of the last history_per_term losses of every timestep
         self._loss_history = np.zeros(
             [diffusion.num_timesteps, history_per_term], dtype=np.float64
         )
-        self._loss_counts = np.zeros([diffusion.num_timesteps], dtype=np.int)
+        self._loss_writes = np.zeros([diffusion.num_timesteps], dtype=np.int64)
 
     def weights(self):
         if not self._warmed_up():
@@ -137,14 +143,30 @@ class LossSecondMomentResampler(LossAwareSampler):
         return weights
 
     def update_with_all_losses(self, ts, losses):
-        for t, loss in zip(ts, losses):
-            if self._loss_counts[t] == self.history_per_term:
-                # Shift out the oldest loss term.
-                self._loss_history[t, :-1] = self._loss_history[t, 1:]
-                self._loss_history[t, -1] = loss
-            else:
-                self._loss_history[t, self._loss_counts[t]] = loss
-                self._loss_counts[t] += 1
+        ts = np.asarray(ts, dtype=np.int64)
+        losses = np.asarray(losses, dtype=np.float64)
+        if len(ts) == 0:
+            return
+        # rank of every loss among the losses of the same timestep, in order
+        order = np.argsort(ts, kind="stable")
+        unique_ts, starts, counts = np.unique(ts[order], return_index=True, return_counts=True)
+        rank = np.empty_like(ts)
+        rank[order] = np.arange(len(ts)) - np.repeat(starts, counts)
+        count = np.empty_like(ts)
+        count[order] = np.repeat(counts, counts)
+        # only the newest history_per_term losses of a timestep survive, so
+        # every remaining loss writes to its own slot of the ring buffer
+        keep = rank >= count - self.history_per_term
+        slots = (self._loss_writes[ts] + rank) % self.history_per_term
+        self._loss_history[ts[keep], slots[keep]] = losses[keep]
+        self._loss_writes[unique_ts] += counts
 
     def _warmed_up(self):
-        return (self._loss_counts == self.history_per_term).all()
+        return (self._loss_writes >= self.history_per_term).all()
+
+    def state_dict(self):
+        return {"loss_history": self._loss_history.copy(), "loss_writes": self._loss_writes.copy()}
+
+    def load_state_dict(self, state_dict):
+        self._loss_history[...] = state_dict["loss_history"]
+        self._loss_writes[...] = state_dict["loss_writes"]
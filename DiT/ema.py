@@ -0,0 +1,115 @@
+"""
+Exponential moving average of DiT weights.
+
+EMA pairs the parameters of the EMA copy with those of the trained model once,
+and updates all of them with one multi-tensor lerp (torch._foreach_lerp_)
+instead of a Python loop of mul_/add_ kernels per tensor. Updates can be
+spaced every k optimizer steps with the decay corrected for the skipped steps,
+run on a side CUDA stream, or run on a CPU copy of the EMA.
+"""
+import torch
+
+
+class EMA:
+    """
+    In-place EMA of the parameters of model in ema_model, call step() after every optimizer step.
+    :param ema_model: the EMA copy of model, e.g. a deepcopy. It may live on the CPU, in which case
+                      the parameters are staged through pinned host memory.
+    :param model: the trained model, not the DDP wrapper. An FSDP model (see sharding.shard_model) pairs
+                  with an identically sharded ema_model, and every rank averages its own shards.
+    :param decay: the decay per optimizer step.
+    :param update_every: update the EMA every update_every-th step only, with the product of the
+                         decays of all steps since the last update.
+    :param warmup: None for a constant decay, "linear" for min(decay, (1 + n) / (10 + n)) or "power"
+                   for min(decay, 1 - (1 + n) ** -warmup_power) at optimizer step n.
+    :param warmup_power: the exponent of the "power" warmup.
+    :param side_stream: if True, update a CUDA EMA on a separate stream, overlapping the next forward.
+                        Call wait() before the optimizer modifies the parameters again.
+    """
+
+    def __init__(self, ema_model, model, decay=0.9999, update_every=1, warmup=None, warmup_power=2 / 3,
+                 side_stream=False):
+        assert update_every >= 1
+        assert warmup in (None, "linear", "power"), f"unknown EMA warmup {warmup}"
+        self.ema_model = ema_model
+        self.decay = decay
+        self.update_every = update_every
+        self.warmup = warmup
+        self.warmup_power = warmup_power
+        ema_params = dict(ema_model.named_parameters())
+        names = [name for name, _ in model.named_parameters()]
+        assert set(names) == set(ema_params), "the EMA model does not match the model"
+        # frozen parameters are included: they equal the model's, and lerp between equal values is exact
+        # the Parameters themselves, not detached tensors, so they follow FSDP re-pointing their .data
+        self.ema_params = [ema_params[name] for name in names]
+        self.model_params = [p for _, p in model.named_parameters()]
+        self._staging = None
+        if self.ema_params[0].device.type == "cpu" and self.model_params[0].is_cuda:
+            self._staging = [torch.empty(p.shape, dtype=p.dtype, pin_memory=True) for p in self.model_params]
+        self._stream = None
+        if side_stream and self.model_params[0].is_cuda:
+            self._stream = torch.cuda.Stream(self.model_params[0].device)
+        self.num_steps = 0
+        self._pending_decay = 1.0
+
+    def decay_at(self, step):
+        """
+        The decay of optimizer step `step`, including warmup.
+        """
+        if self.warmup == "linear":
+            return min(self.decay, (1 + step) / (10 + step))
+        if self.warmup == "power":
+            return min(self.decay, 1 - (1 + step) ** -self.warmup_power)
+        return self.decay
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Account for one optimizer step, and update the EMA if it is due.
+        """
+        self._pending_decay *= self.decay_at(self.num_steps)
+        self.num_steps += 1
+        if self.num_steps % self.update_every == 0:
+            self.update(self._pending_decay)
+            self._pending_decay = 1.0
+
+    @torch.no_grad()
+    def update(self, decay):
+        """
+        ema = decay * ema + (1 - decay) * model, for all parameters at once.
+        """
+        if self._stream is None:
+            self._lerp(1 - decay)
+            return
+        # the side stream must see the finished optimizer step
+        self._stream.wait_stream(torch.cuda.current_stream(self._stream.device))
+        with torch.cuda.stream(self._stream):
+            self._lerp(1 - decay)
+
+    def _lerp(self, weight):
+        sources = self.model_params
+        if self._staging is not None:
+            for staging, p in zip(self._staging, sources):
+                staging.copy_(p, non_blocking=True)
+            torch.cuda.current_stream(sources[0].device).synchronize()
+            sources = self._staging
+        if weight == 1.0:
+            # copy exactly, lerp with weight 1 may be off by rounding
+            for ema_p, p in zip(self.ema_params, sources):
+                ema_p.copy_(p)
+        else:
+            torch._foreach_lerp_(self.ema_params, sources, weight)
+
+    def wait(self):
+        """
+        Make the current stream wait for an update running on the side stream.
+        """
+        if self._stream is not None:
+            torch.cuda.current_stream(self._stream.device).wait_stream(self._stream)
+
+    def state_dict(self):
+        return {"num_steps": self.num_steps, "pending_decay": self._pending_decay}
+
+    def load_state_dict(self, state_dict):
+        self.num_steps = state_dict["num_steps"]
+        self._pending_decay = state_dict["pending_decay"]
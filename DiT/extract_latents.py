@@ -0,0 +1,131 @@
+"""
+Pre-computes VQ-VAE latents of UCF101ClassConditionedDataset clips for DiT training.
+
+Every rank encodes a disjoint subset of the videos and appends the latents to raw,
+memory-mappable shards. The clip index (label, shard offset, valid extents and the
+sampled frame window) is saved next to them, and train.py reads everything back
+through LatentDataset with --latent-path, so the frozen encoder is run only once.
+"""
+import argparse
+import json
+import os
+import random
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn import functional as F
+from tqdm import tqdm
+from decord import VideoReader, cpu
+from videogpt import load_vqvae
+
+from models import DiT_models
+from videodata import UCF101ClassConditionedDataset, LATENT_INDEX_DTYPE, latent_shard_path, pad_to_multiple, \
+    update_video_index
+
+
+@torch.no_grad()
+def main(args):
+    assert torch.cuda.is_available(), "Latent extraction currently requires at least one GPU."
+
+    dist.init_process_group("nccl")
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    device = rank % torch.cuda.device_count()
+    seed = args.global_seed * world_size + rank
+    random.seed(seed)
+    torch.cuda.set_device(device)
+    os.makedirs(args.latent_path, exist_ok=True)
+
+    vae_stride_t, vae_stride_h, vae_stride_w = [int(i) for i in args.vae[-5:].split('x')]
+    patch_size = args.model[-3:]
+    patch_size_t, patch_size_h = int(patch_size[0]), int(patch_size[1])
+    ds_stride = vae_stride_h * patch_size_h
+    t_ds_stride = vae_stride_t * patch_size_t
+
+    vae = load_vqvae(args.vae, root='./').to(device)
+    if args.video_index is not None:
+        if rank == 0:
+            update_video_index(args.data_path, args.video_index)
+        dist.barrier()
+    # dynamic frames are applied when reading the latents back, so always store the full window here
+    dataset = UCF101ClassConditionedDataset(args.data_path, args.sample_rate, args.num_frames, args.max_image_size,
+                                            dynamic_frames=False, video_index=args.video_index)
+    dtype = np.dtype(args.dtype)
+    max_shard_bytes = int(args.shard_size_gb * 2 ** 30)
+
+    rows = []
+    shard, shard_bytes, offset = 0, 0, 0
+    shard_file = open(latent_shard_path(args.latent_path, rank, shard), 'wb')
+    for video_idx in tqdm(range(rank, len(dataset), world_size), disable=rank != 0):
+        video_path, label = dataset.samples[video_idx]
+        try:
+            decord_vr = VideoReader(video_path, ctx=cpu(0))
+            total_frames = len(decord_vr) if dataset.video_index is None else int(dataset.video_index['num_frames'][video_idx])
+            frame_id_lists = [dataset.get_frame_ids(total_frames, video_path) for _ in range(args.clips_per_video)]
+            videos = [dataset.transform(dataset.read_frames(decord_vr, i)) for i in frame_id_lists]
+        except Exception as e:
+            print(f'Error with {e}, {video_path}')
+            continue
+
+        # all clips of a video share one shape, so they are encoded as a single batch
+        c, t, h, w = videos[0].shape
+        pad_t, pad_h, pad_w = pad_to_multiple(t, t_ds_stride), pad_to_multiple(h, ds_stride), pad_to_multiple(w, ds_stride)
+        x = torch.stack([F.pad(v, (0, pad_w - w, 0, pad_h - h, 0, pad_t - t), value=0) for v in videos]).to(device)
+        latents = vae.pre_vq_conv(vae.encoder(x)).cpu().numpy().astype(dtype)
+
+        if shard_bytes > 0 and shard_bytes + latents.nbytes > max_shard_bytes:
+            shard_file.close()
+            shard, shard_bytes, offset = shard + 1, 0, 0
+            shard_file = open(latent_shard_path(args.latent_path, rank, shard), 'wb')
+        for clip_idx, (latent, frame_id_list) in enumerate(zip(latents, frame_id_lists)):
+            shard_file.write(np.ascontiguousarray(latent).tobytes())
+            rows.append((video_idx, clip_idx, label, rank, shard, offset, *latent.shape[1:],
+                         int(np.ceil(t / vae_stride_t)), int(np.ceil(h / vae_stride_h)), int(np.ceil(w / vae_stride_w)),
+                         frame_id_list[0], frame_id_list[-1], len(frame_id_list)))
+            offset += latent.size
+            shard_bytes += latent.nbytes
+    shard_file.close()
+
+    np.save(os.path.join(args.latent_path, f'index_{rank:03d}.npy'), np.array(rows, dtype=LATENT_INDEX_DTYPE))
+    dist.barrier()
+    if rank == 0:
+        meta = {
+            'vae': args.vae,
+            'model': args.model,
+            'sample_rate': args.sample_rate,
+            'num_frames': args.num_frames,
+            'max_image_size': args.max_image_size,
+            'clips_per_video': args.clips_per_video,
+            'dtype': dtype.name,
+            'channels': int(vae.args.embedding_dim),
+            'classes': dataset.classes,
+            'world_size': world_size,
+        }
+        with open(os.path.join(args.latent_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        print(f"Saved latents of {len(dataset):,} videos to {args.latent_path}")
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--latent-path", type=str, required=True)
+    parser.add_argument("--video-index", type=str, default=None)
+    parser.add_argument("--model", type=str, choices=list(DiT_models.keys()), default="DiT-XL/122",
+                        help="only used for its patch size, latents are padded to whole patches")
+    parser.add_argument("--vae", type=str, choices=['bair_stride4x2x2', 'ucf101_stride4x4x4',
+                                                      'kinetics_stride4x4x4', 'kinetics_stride2x4x4'],
+                        default="ucf101_stride4x4x4")
+    parser.add_argument("--sample-rate", type=int, default=4)
+    parser.add_argument("--num-frames", type=int, default=16)
+    parser.add_argument("--max-image-size", type=int, default=128)
+    parser.add_argument("--clips-per-video", type=int, default=4,
+                        help="number of random frame windows stored per video, one is drawn per epoch")
+    parser.add_argument("--dtype", type=str, choices=['float16', 'float32'], default='float16')
+    parser.add_argument("--shard-size-gb", type=float, default=4.0)
+    parser.add_argument("--global-seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
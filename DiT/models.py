@@ -5,9 +5,11 @@
 # GLIDE: https://github.com/openai/glide-text2im
 # MAE: https://github.com/facebookresearch/mae/blob/main/models_mae.py
 # --------------------------------------------------------
+from functools import lru_cache
 from typing import Final, Optional
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import numpy as np
 import math
@@ -18,9 +20,18 @@ from timm.layers import use_fused_attn, to_2tuple
 from timm.models.vision_transformer import PatchEmbed, Mlp
 from torch.nn import functional as F
 
+import triton_ops
+
+try:
+    from flash_attn import flash_attn_varlen_func
+except ImportError:
+    flash_attn_varlen_func = None
+
 
 class Attention(nn.Module):
     fused_attn: Final[bool]
+    # process group of sequence-parallel inference, see DiT.enable_sequence_parallel()
+    sp_group = None
 
     def __init__(
             self,
@@ -46,43 +57,273 @@ class Attention(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x: torch.Tensor, attention_mask) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, attention_mask, packing=None) -> torch.Tensor:
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
         q, k, v = qkv.unbind(0)
         q, k = self.q_norm(q), self.k_norm(k)
-
-        if self.fused_attn:
-            x = F.scaled_dot_product_attention(
-                q, k, v,
-                attn_mask=attention_mask,
-                dropout_p=self.attn_drop.p if self.training else 0.,
-            )
+        if self.sp_group is not None:
+            # Ulysses: swap the sequence shard for a head shard and attend over the full sequence
+            q, k, v = [sequence_to_head_shard(i, self.sp_group) for i in (q, k, v)]
+
+        dropout_p = self.attn_drop.p if self.training else 0.
+        if packing is not None:
+            x = varlen_attention(q, k, v, packing['cu_seqlens'], dropout_p=dropout_p, fused=self.fused_attn,
+                                 groups=packing.get('groups'))
+        elif attention_mask is not None:
+            if not isinstance(attention_mask, KeyPaddingMask):
+                attention_mask = KeyPaddingMask(attention_mask.flatten(1).bool())  # bs t h w -> bs thw
+            x = masked_attention(q, k, v, attention_mask, dropout_p=dropout_p, fused=self.fused_attn)
+        elif self.fused_attn:
+            x = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
         else:
             q = q * self.scale
             attn = q @ k.transpose(-2, -1)
-            if attention_mask is not None:
-                attention_mask = attention_mask.flatten(1).unsqueeze(-1)  # bs t h w -> bs thw 1
-                attention_mask = attention_mask @ attention_mask.transpose(1, 2)  # bs thw 1 @ bs 1 thw = bs thw thw
-                attention_mask = attention_mask.unsqueeze(1)
-                assert attn.shape[0] == attention_mask.shape[0]
-                attention_mask = attention_mask.masked_fill(attention_mask == 0, torch.finfo(attn.dtype).min)
-                attn = attn + attention_mask
-            attn = attn.softmax(dim=-1)
-            if torch.any(torch.isnan(attn)):
-                print('torch.any(torch.isnan(attn))')
-                attn = attn.masked_fill(torch.isnan(attn), float(0.))
+            # softmax in fp32 also under bf16/fp16 autocast
+            attn = attn.softmax(dim=-1, dtype=torch.float32).to(v.dtype)
             attn = self.attn_drop(attn)
             x = attn @ v
 
+        if self.sp_group is not None:
+            x = head_to_sequence_shard(x, self.sp_group)
         x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
 
+def _attention(q, k, v, dropout_p, fused, attn_mask=None):
+    if fused:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    attn = (q * q.shape[-1] ** -0.5) @ k.transpose(-2, -1)
+    if attn_mask is not None:
+        attn = attn.masked_fill(~attn_mask, float('-inf'))
+    attn = F.dropout(attn.softmax(dim=-1, dtype=torch.float32).to(v.dtype), p=dropout_p)
+    return attn @ v
+
+
+def varlen_attention(q, k, v, cu_seqlens, dropout_p=0., fused=True, groups=None):
+    """
+    Block-diagonal attention over sequences packed along the token axis: tokens only attend
+    to the tokens of their own sequence, without materializing any (N x N) mask.
+    Uses flash-attn's varlen kernel when it is installed and applicable. Otherwise, with groups,
+    the sequences of every length are attended as one batch, and without them sequence by
+    sequence, which also serves as the CPU reference implementation.
+    q, k, v: (1, num_heads, N, head_dim) tensors of all packed sequences
+    cu_seqlens: (S + 1,) tensor of token offsets, sequence i spans [cu_seqlens[i], cu_seqlens[i + 1])
+    groups: optional group_sequences() of the same sequences
+    """
+    if flash_attn_varlen_func is not None and q.is_cuda and q.dtype in (torch.float16, torch.bfloat16):
+        cu_seqlens = cu_seqlens.to(device=q.device, dtype=torch.int32)
+        if groups is not None:
+            max_seqlen = groups['max_seqlen']
+        else:
+            max_seqlen = int((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+        q, k, v = [i[0].transpose(0, 1) for i in (q, k, v)]  # (N, num_heads, head_dim)
+        x = flash_attn_varlen_func(q, k, v, cu_seqlens, cu_seqlens, max_seqlen, max_seqlen, dropout_p=dropout_p)
+        return x.transpose(0, 1).unsqueeze(0)
+    if groups is not None:
+        return grouped_attention(q, k, v, groups, dropout_p=dropout_p, fused=fused)
+
+    out = []
+    for start, end in zip(cu_seqlens[:-1].tolist(), cu_seqlens[1:].tolist()):
+        if start == end:  # e.g. a fully padded frame in factorized attention
+            continue
+        out.append(_attention(q[:, :, start:end], k[:, :, start:end], v[:, :, start:end], dropout_p, fused))
+    return torch.cat(out, dim=2)
+
+
+def group_sequences(blocks, device):
+    """
+    Group packed sequences by length, so that attention runs over the sequences of every length as one batch.
+    Computed once per forward pass from host-side sizes, see grouped_attention().
+    :param blocks: (start, S, L) tuples: S sequences of L tokens each, stored back to back from token start on,
+                   e.g. the frames or the patch locations of a clip.
+    :return: a dict with perm, the token order that puts the groups (by increasing L) back to back, or None
+             if that is the identity, its inverse perm_inv, shapes, the (S, L) of every group, and max_seqlen.
+    """
+    groups = {}
+    for start, S, L in blocks:
+        if S * L > 0:
+            groups.setdefault(L, []).append(torch.arange(start, start + S * L))
+    lengths = sorted(groups)
+    perm = torch.cat([i for L in lengths for i in groups[L]])
+    shapes = [(sum(len(i) for i in groups[L]) // L, L) for L in lengths]
+    if torch.equal(perm, torch.arange(len(perm))):
+        perm, perm_inv = None, None
+    else:
+        perm, perm_inv = perm.to(device), torch.argsort(perm).to(device)
+    return dict(perm=perm, perm_inv=perm_inv, shapes=shapes, max_seqlen=max(lengths))
+
+
+def grouped_attention(q, k, v, groups, dropout_p=0., fused=True):
+    """
+    Block-diagonal attention over packed sequences with one dense attention call per sequence length.
+    q, k, v: (1, num_heads, N, head_dim) tensors of all packed sequences
+    groups: group_sequences() of the sequences
+    """
+    if groups['perm'] is not None:
+        q, k, v = [i[:, :, groups['perm']] for i in (q, k, v)]
+    out, offset = [], 0
+    for S, L in groups['shapes']:
+        # (1, num_heads, S * L, head_dim) -> (S, num_heads, L, head_dim)
+        batch = [i[0, :, offset:offset + S * L].unflatten(1, (S, L)).transpose(0, 1) for i in (q, k, v)]
+        out.append(_attention(*batch, dropout_p, fused).transpose(0, 1).flatten(1, 2))
+        offset += S * L
+    x = torch.cat(out, dim=1).unsqueeze(0)
+    return x if groups['perm'] is None else x[:, :, groups['perm_inv']]
+
+
+class KeyPaddingMask:
+    """
+    Key-padding mask of a padded batch, prepared once per forward pass and shared by all attention layers,
+    so the layers neither recompute it nor synchronize with the host.
+    :param mask: (B, N) bool tensor, True for valid tokens.
+    """
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.all_valid = bool(mask.all())  # the only host sync, once per forward pass
+        self._sdpa_mask = None
+        self._packed = None
+        self._derived = {}
+
+    @property
+    def sdpa_mask(self):
+        """
+        The (B, 1, 1, N) boolean attention mask of the keys. Rows without any valid token (e.g. fully padded
+        frames in factorized attention) attend to all keys instead, which keeps them finite; their output
+        is zeroed anyway.
+        """
+        if self._sdpa_mask is None:
+            self._sdpa_mask = (self.mask | ~self.mask.any(dim=1, keepdim=True))[:, None, None, :]
+        return self._sdpa_mask
+
+    def packed(self):
+        """
+        The indices of the valid tokens in the flattened (B * N) batch, their cu_seqlens and the longest sequence,
+        for varlen kernels.
+        """
+        if self._packed is None:
+            seqlens = self.mask.sum(dim=1)
+            indices = self.mask.flatten().nonzero(as_tuple=True)[0]
+            cu_seqlens = F.pad(seqlens.cumsum(0), (1, 0)).to(torch.int32)
+            self._packed = indices, cu_seqlens, int(seqlens.max())
+        return self._packed
+
+    def derive(self, key, fn):
+        """
+        The KeyPaddingMask of the mask rearranged by fn, e.g. into the rows of factorized attention,
+        computed once and cached under key.
+        """
+        if key not in self._derived:
+            self._derived[key] = KeyPaddingMask(fn(self.mask))
+        return self._derived[key]
+
+
+def masked_attention(q, k, v, key_padding_mask, dropout_p=0., fused=True):
+    """
+    Attention of a padded batch in which every sample only sees its own valid tokens; the output at
+    padded positions is zero. With flash-attn (CUDA, fp16/bf16) only the valid tokens are packed and
+    attended; otherwise the whole batch goes through one SDPA call with a broadcast boolean key mask.
+    q, k, v: (B, num_heads, N, head_dim) tensors
+    key_padding_mask: KeyPaddingMask of the (B, N) valid tokens
+    """
+    if key_padding_mask.all_valid:  # nothing to drop
+        return _attention(q, k, v, dropout_p, fused)
+    B, num_heads, N, head_dim = q.shape
+
+    if flash_attn_varlen_func is not None and q.is_cuda and q.dtype in (torch.float16, torch.bfloat16):
+        indices, cu_seqlens, max_seqlen = key_padding_mask.packed()
+
+        def pack(x):  # (B, num_heads, N, head_dim) -> (total_valid, num_heads, head_dim)
+            return x.transpose(1, 2).reshape(B * N, num_heads, head_dim)[indices]
+
+        x = flash_attn_varlen_func(pack(q), pack(k), pack(v), cu_seqlens, cu_seqlens, max_seqlen, max_seqlen,
+                                   dropout_p=dropout_p)
+        out = q.new_zeros(B * N, num_heads, head_dim)
+        out[indices] = x
+        return out.view(B, N, num_heads, head_dim).transpose(1, 2)
+
+    x = _attention(q, k, v, dropout_p, fused, attn_mask=key_padding_mask.sdpa_mask)
+    return x.masked_fill(~key_padding_mask.mask[:, None, :, None], 0.)
+
+
+def sequence_to_head_shard(x, group):
+    """
+    Ulysses all-to-all of sequence-parallel attention: (B, num_heads, N / P, head_dim) shards of the
+    sequence with all heads -> (B, num_heads / P, N, head_dim) shards of the heads with the full sequence,
+    where P is the size of the process group and rank r gets the r-th group of heads.
+    """
+    P = dist.get_world_size(group)
+    B, num_heads, n, head_dim = x.shape
+    x = x.reshape(B, P, num_heads // P, n, head_dim).transpose(0, 1).contiguous()
+    out = torch.empty_like(x)
+    dist.all_to_all_single(out, x, group=group)  # out[r] is the sequence shard of rank r
+    return out.permute(1, 2, 0, 3, 4).reshape(B, num_heads // P, P * n, head_dim)
+
+
+def head_to_sequence_shard(x, group):
+    """
+    Inverse of sequence_to_head_shard(): (B, num_heads / P, N, head_dim) -> (B, num_heads, N / P, head_dim).
+    """
+    P = dist.get_world_size(group)
+    B, heads, N, head_dim = x.shape
+    x = x.reshape(B, heads, P, N // P, head_dim).permute(2, 0, 1, 3, 4).contiguous()
+    out = torch.empty_like(x)
+    dist.all_to_all_single(out, x, group=group)  # out[r] is the head shard of rank r
+    return out.transpose(0, 1).reshape(B, P * heads, N // P, head_dim)
+
+
 def modulate(x, shift, scale):
-    return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
+    return x * (1 + scale) + shift
+
+
+def fused_layer_norm_modulate(x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor, eps: float) -> torch.Tensor:
+    """
+    modulate(LayerNorm(x), shift, scale) for a LayerNorm without affine parameters.
+    On CUDA with triton installed this is a single kernel (triton_ops.layer_norm_modulate()). Otherwise,
+    and under torch.compile which fuses it itself, the modulation is done by a single addcmul instead of
+    two elementwise ops and their (B, N, D) temporaries.
+    """
+    if triton_ops.can_fuse(x):
+        return triton_ops.layer_norm_modulate(x, shift, scale, eps)
+    return torch.addcmul(shift, F.layer_norm(x, [x.shape[-1]], eps=eps), 1 + scale)
+
+
+def fused_gated_residual(x: torch.Tensor, gate: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    """
+    x + gate * y as a single addcmul, which already is one elementwise kernel.
+    """
+    return torch.addcmul(x, gate, y)
+
+
+class AdaLNMixin:
+    """
+    Switches the adaLN norm/modulate/gate steps of a block between the reference elementwise ops
+    and the fused_layer_norm_modulate() / fused_gated_residual() path (fused_adaln).
+    """
+    fused_adaln = False
+
+    def norm_modulate(self, norm, x, shift, scale):
+        if self.fused_adaln:
+            return fused_layer_norm_modulate(x, shift, scale, norm.eps)
+        return modulate(norm(x), shift, scale)
+
+    def gated_residual(self, x, gate, y):
+        if self.fused_adaln:
+            return fused_gated_residual(x, gate, y)
+        return x + gate * y
+
+
+def expand_modulation(modulation, packing=None):
+    """
+    Make (B, K) per-sample adaLN parameters broadcastable over the tokens of x: (B, 1, K),
+    or (1, N, K) for packed sequences, where every token takes the parameters of its own clip.
+    """
+    if packing is None:
+        return modulation.unsqueeze(1)
+    return modulation[packing['seq_ids']].unsqueeze(0)
 
 
 #################################################################################
@@ -159,11 +400,43 @@ class LabelEmbedder(nn.Module):
         return embeddings
 
 
+class ConditioningCache:
+    """
+    Sampling-time cache of the DiT conditioning c = t_embedder(t) + y_embedder(y).
+    The timestep embeddings of every timestep of a (respaced) schedule and the label embeddings of
+    one sampling request (including the null labels of a classifier-free guidance batch) are
+    computed once, so a denoising step only gathers rows instead of re-running the timestep MLP.
+    See DiT.conditioning_cache(); SpacedDiffusion attaches one to its sampling loops automatically.
+    """
+    def __init__(self, model, timesteps, y):
+        with torch.no_grad():
+            timesteps = torch.as_tensor(timesteps, device=y.device).long()
+            self.t_index = torch.full((int(timesteps.max()) + 1,), -1, dtype=torch.long, device=y.device)
+            self.t_index[timesteps] = torch.arange(len(timesteps), device=y.device)
+            self.t_emb = model.t_embedder(timesteps)       # (S, D)
+            self.y_emb = model.y_embedder(y, train=False)  # (B, D)
+        self.t_embedder = model.t_embedder
+
+    def __call__(self, t, y):
+        """
+        :param t: (B,) tensor of timesteps, those outside the cached schedule are embedded directly.
+        :param y: (B,) tensor of labels, must be the labels the cache was built with.
+        :return: (B, D) tensor of conditioning vectors.
+        """
+        assert y.shape[0] == self.y_emb.shape[0], "ConditioningCache was built for a different batch."
+        t = t.long()
+        index = self.t_index[t.clamp(0, len(self.t_index) - 1)]
+        if not bool(((index >= 0) & (t >= 0) & (t < len(self.t_index))).all()):
+            with torch.no_grad():
+                return self.t_embedder(t) + self.y_emb
+        return self.t_emb[index] + self.y_emb
+
+
 #################################################################################
 #                                 Core DiT Model                                #
 #################################################################################
 
-class DiTBlock(nn.Module):
+class DiTBlock(AdaLNMixin, nn.Module):
     """
     A DiT block with adaptive layer norm zero (adaLN-Zero) conDiTioning.
     """
@@ -180,14 +453,75 @@ class DiTBlock(nn.Module):
             nn.Linear(hidden_size, 6 * hidden_size, bias=True)
         )
 
-    def forward(self, x, c, attention_mask):
-        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(6, dim=1)
-        x = x + gate_msa.unsqueeze(1) * self.attn(modulate(self.norm1(x), shift_msa, scale_msa), attention_mask)
-        x = x + gate_mlp.unsqueeze(1) * self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
+    def adaLN_modulations(self):
+        return [self.adaLN_modulation]
+
+    def forward(self, x, c, attention_mask, packing=None, grid_size=None, modulation=None):
+        if modulation is None:
+            modulation = [m(c) for m in self.adaLN_modulations()]
+        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = \
+            expand_modulation(modulation[0], packing).chunk(6, dim=-1)
+        x = self.gated_residual(x, gate_msa, self.attn(self.norm_modulate(self.norm1, x, shift_msa, scale_msa),
+                                                       attention_mask, packing))
+        x = self.gated_residual(x, gate_mlp, self.mlp(self.norm_modulate(self.norm2, x, shift_mlp, scale_mlp)))
         return x
 
 
-class FinalLayer(nn.Module):
+class FactorizedDiTBlock(DiTBlock):
+    """
+    A DiT block whose full attention is factorized into spatial attention among the patches of every frame,
+    followed by temporal attention among the frames at every patch location.
+    The spatial branch keeps DiTBlock's parameter names, so image DiT checkpoints load into it; the temporal
+    branch has its own adaLN modulation, zero-initialized like the others, so it starts as an identity.
+    """
+    def __init__(self, hidden_size, num_heads, mlp_ratio=4.0, **block_kwargs):
+        super().__init__(hidden_size, num_heads, mlp_ratio=mlp_ratio, **block_kwargs)
+        self.norm_temporal = nn.LayerNorm(hidden_size, elementwise_affine=False, eps=1e-6)
+        self.temporal_attn = Attention(hidden_size, num_heads=num_heads, qkv_bias=True, **block_kwargs)
+        self.temporal_adaLN_modulation = nn.Sequential(
+            nn.SiLU(),
+            nn.Linear(hidden_size, 3 * hidden_size, bias=True)
+        )
+
+    def spatial_attention(self, x, attention_mask, packing, grid_size):
+        if packing is not None:
+            return self.attn(x, None, dict(cu_seqlens=packing['spatial_cu_seqlens'], groups=packing['spatial_groups']))
+        B, N, D = x.shape
+        t, h, w = grid_size
+        if attention_mask is not None:
+            attention_mask = attention_mask.derive('spatial', lambda m: m.reshape(B * t, h * w))
+        return self.attn(x.reshape(B * t, h * w, D), attention_mask).reshape(B, N, D)
+
+    def temporal_attention(self, x, attention_mask, packing, grid_size):
+        if packing is not None:
+            x = self.temporal_attn(x[:, packing['temporal_perm']], None,
+                                   dict(cu_seqlens=packing['temporal_cu_seqlens'], groups=packing['temporal_groups']))
+            return x[:, packing['temporal_perm_inv']]
+        B = x.shape[0]
+        t = grid_size[0]
+        if attention_mask is not None:
+            attention_mask = attention_mask.derive('temporal', lambda m: rearrange(m, 'b (t n) -> (b n) t', t=t))
+        x = self.temporal_attn(rearrange(x, 'b (t n) d -> (b n) t d', t=t), attention_mask)
+        return rearrange(x, '(b n) t d -> b (t n) d', b=B)
+
+    def adaLN_modulations(self):
+        return [self.adaLN_modulation, self.temporal_adaLN_modulation]
+
+    def forward(self, x, c, attention_mask, packing=None, grid_size=None, modulation=None):
+        if modulation is None:
+            modulation = [m(c) for m in self.adaLN_modulations()]
+        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = \
+            expand_modulation(modulation[0], packing).chunk(6, dim=-1)
+        shift_tmp, scale_tmp, gate_tmp = expand_modulation(modulation[1], packing).chunk(3, dim=-1)
+        x = self.gated_residual(x, gate_msa, self.spatial_attention(
+            self.norm_modulate(self.norm1, x, shift_msa, scale_msa), attention_mask, packing, grid_size))
+        x = self.gated_residual(x, gate_tmp, self.temporal_attention(
+            self.norm_modulate(self.norm_temporal, x, shift_tmp, scale_tmp), attention_mask, packing, grid_size))
+        x = self.gated_residual(x, gate_mlp, self.mlp(self.norm_modulate(self.norm2, x, shift_mlp, scale_mlp)))
+        return x
+
+
+class FinalLayer(AdaLNMixin, nn.Module):
     """
     The final layer of DiT.
     """
@@ -200,9 +534,11 @@ class FinalLayer(nn.Module):
             nn.Linear(hidden_size, 2 * hidden_size, bias=True)
         )
 
-    def forward(self, x, c):
-        shift, scale = self.adaLN_modulation(c).chunk(2, dim=1)
-        x = modulate(self.norm_final(x), shift, scale)
+    def forward(self, x, c, packing=None, modulation=None):
+        if modulation is None:
+            modulation = self.adaLN_modulation(c)
+        shift, scale = expand_modulation(modulation, packing).chunk(2, dim=-1)
+        x = self.norm_modulate(self.norm_final, x, shift, scale)
         x = self.linear(x)
         return x
 
@@ -224,9 +560,17 @@ class DiT(nn.Module):
         class_dropout_prob=0.1,
         num_classes=1000,
         learn_sigma=True,
+        full_attn_every=None,
+        fused_adaln=False,
+        batched_adaln=False,
     ):
         super().__init__()
         self.gradient_checkpointing = False
+        # compute all adaLN modulations in one matmul when gradients are off (sampling), see batched_modulation()
+        self.batched_adaln = batched_adaln
+        self._adaLN_packed = None
+        # process group of sequence-parallel inference, see enable_sequence_parallel()
+        self.sp_group = None
 
         self.learn_sigma = learn_sigma
         self.in_channels = in_channels
@@ -243,10 +587,14 @@ class DiT(nn.Module):
         # Will use fixed sin-cos embedding:
         # self.pos_embed = nn.Parameter(torch.zeros(1, num_patches, hidden_size), requires_grad=False)
 
+        # full_attn_every=k keeps full attention in every k-th block and factorizes the others
         self.blocks = nn.ModuleList([
-            DiTBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio) for _ in range(depth)
+            DiTBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio)
+            if full_attn_every is None or i % full_attn_every == full_attn_every - 1
+            else FactorizedDiTBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio) for i in range(depth)
         ])
         self.final_layer = FinalLayer(hidden_size, patch_size_t, patch_size, self.out_channels)
+        self.set_fused_adaln(fused_adaln)
         self.initialize_weights()
 
     def initialize_weights(self):
@@ -278,6 +626,9 @@ class DiT(nn.Module):
         for block in self.blocks:
             nn.init.constant_(block.adaLN_modulation[-1].weight, 0)
             nn.init.constant_(block.adaLN_modulation[-1].bias, 0)
+            if isinstance(block, FactorizedDiTBlock):
+                nn.init.constant_(block.temporal_adaLN_modulation[-1].weight, 0)
+                nn.init.constant_(block.temporal_adaLN_modulation[-1].bias, 0)
 
         # Zero-out output layers:
         nn.init.constant_(self.final_layer.adaLN_modulation[-1].weight, 0)
@@ -285,6 +636,100 @@ class DiT(nn.Module):
         nn.init.constant_(self.final_layer.linear.weight, 0)
         nn.init.constant_(self.final_layer.linear.bias, 0)
 
+    def set_fused_adaln(self, enabled=True):
+        """
+        Select the fused norm + modulate + gate path of all blocks and the final layer.
+        Both paths compute the same function and share the parameters.
+        """
+        for module in self.modules():
+            if isinstance(module, AdaLNMixin):
+                module.fused_adaln = enabled
+
+    def enable_sequence_parallel(self, group=None):
+        """
+        Shard the token sequence of forward() over the ranks of a process group (default: all ranks) for
+        inference on videos whose activations do not fit on one device. Every rank keeps N / P tokens through
+        the token-wise layers, and attention exchanges sequence shards for head shards with an all-to-all
+        (Ulysses), so num_heads must be divisible by the group size. All ranks must run the same forward
+        passes on identical inputs; they all get the full output. The SpacedDiffusion sampling loops take
+        care of this. Works with NCCL on GPUs as well as with gloo on CPU, e.g. for testing on one machine.
+        Weights are unchanged; inference only, factorized blocks and packed sequences are not supported.
+        """
+        if group is None:
+            group = dist.group.WORLD
+        assert not any(isinstance(block, FactorizedDiTBlock) for block in self.blocks), \
+            "Sequence parallelism needs full-attention blocks."
+        assert self.num_heads % dist.get_world_size(group) == 0, "num_heads must be divisible by the group size."
+        self.set_sequence_parallel_group(group)
+
+    def disable_sequence_parallel(self):
+        self.set_sequence_parallel_group(None)
+
+    def set_sequence_parallel_group(self, group):
+        self.sp_group = group
+        for module in self.modules():
+            if isinstance(module, Attention):
+                module.sp_group = group
+
+    def shard_sequence(self, x, attention_mask):
+        """
+        Keep this rank's contiguous shard of the (B, N, D) tokens, zero-padded so that all ranks hold the
+        same number of tokens, and return it with the (B, N_padded) key-padding mask of the full sequence,
+        which is None if no token is masked.
+        """
+        P, rank = dist.get_world_size(self.sp_group), dist.get_rank(self.sp_group)
+        B, N, _ = x.shape
+        n = -(-N // P)
+        if attention_mask is not None or n * P != N:
+            if attention_mask is None:
+                attention_mask = torch.ones(B, N, dtype=torch.bool, device=x.device)
+            attention_mask = F.pad(attention_mask.flatten(1).bool(), (0, n * P - N), value=False)
+        x = F.pad(x, (0, 0, 0, n * P - N))
+        return x[:, rank * n:(rank + 1) * n], attention_mask
+
+    def gather_sequence(self, x, N):
+        """
+        All-gather the (B, N / P, K) shards of shard_sequence() into the (B, N, K) full sequence.
+        """
+        shards = [torch.empty_like(x) for _ in range(dist.get_world_size(self.sp_group))]
+        dist.all_gather(shards, x.contiguous(), group=self.sp_group)
+        return torch.cat(shards, dim=1)[:, :N]
+
+    def batched_modulation(self, c):
+        """
+        Compute the adaLN modulations of all blocks and the final layer of conditioning c in a single matmul.
+        The adaLN Linear weights are re-pointed into one packed buffer on first use (and again whenever
+        they were moved or replaced), so they keep their state dict names and no second copy is kept.
+        Gradients do not reach the blocks' parameters through the packed buffer: only use it without grad.
+        :return: a tuple (per-block lists of modulations, final layer modulation).
+        """
+        linears = [m[-1] for block in self.blocks for m in block.adaLN_modulations()]
+        linears.append(self.final_layer.adaLN_modulation[-1])
+        data_ptrs = [(l.weight.data_ptr(), l.bias.data_ptr()) for l in linears]
+        if self._adaLN_packed is None or self._adaLN_packed[2] != data_ptrs:
+            self._pack_adaLN(linears)
+        weight, bias, _ = self._adaLN_packed
+
+        # every adaLN_modulation is SiLU followed by a Linear
+        out = list(F.linear(F.silu(c), weight, bias).split([l.out_features for l in linears], dim=-1))
+        modulation = []
+        for block in self.blocks:
+            num = len(block.adaLN_modulations())
+            modulation.append(out[:num])
+            out = out[num:]
+        return modulation, out[0]
+
+    @torch.no_grad()
+    def _pack_adaLN(self, linears):
+        weight = torch.cat([l.weight for l in linears])
+        bias = torch.cat([l.bias for l in linears])
+        offset = 0
+        for l in linears:
+            l.weight.data = weight[offset:offset + l.out_features]
+            l.bias.data = bias[offset:offset + l.out_features]
+            offset += l.out_features
+        self._adaLN_packed = (weight, bias, [(l.weight.data_ptr(), l.bias.data_ptr()) for l in linears])
+
     def unpatchify(self, x):
         """
         x: (B, N, patch_size_t*patch_size**2 * C)
@@ -306,13 +751,33 @@ class DiT(nn.Module):
             return outputs
         return ckpt_forward
 
-    def forward(self, x, t, y, attention_mask):
+    def get_pos_embed(self, t, h, w, device, dtype=torch.float32):
+        """
+        Fixed sin-cos positional embeddings of a (t, h, w) patch grid:
+        a (1, h * w, D) spatial one and a (1, t, D) temporal one.
+        They are cached on the device, so repeated grid sizes cost no host work or copies.
+        """
+        return get_cached_sincos_pos_embed(t, h, w, self.hidden_size, torch.device(device), dtype)
+
+    def conditioning_cache(self, timesteps, y):
+        """
+        Precompute the conditioning of labels y for the given diffusion timesteps, see ConditioningCache.
+        """
+        return ConditioningCache(self, timesteps, y)
+
+    def forward(self, x, t, y, attention_mask=None, packing=None, cond_cache=None, block_cache=None):
         """
         Forward pass of DiT.
         x: (B, D, T, H, W) tensor of spatial inputs (images or latent representations of images)
         t: (B,) tensor of diffusion timesteps
         y: (B,) tensor of class labels
+        packing: if not None, x holds packed clips, see forward_packed()
+        cond_cache: optional ConditioningCache built for y, replaces the timestep and label embedders
+        block_cache: optional block_cache.BlockCache, reuses the output of a range of blocks across sampling steps
         """
+        if packing is not None:
+            assert block_cache is None, "Packed sequences do not support the block cache."
+            return self.forward_packed(x, t, y, packing, cond_cache)
         if x.ndim == 4:
             raise NotImplementedError
         B, D, T, H, W = x.shape
@@ -320,40 +785,124 @@ class DiT(nn.Module):
         self.w = num_patches_width = W // self.patch_size
         self.t = num_tubes_length = T // self.patch_size_t  # 4 // 1
 
-        pos_embed = get_2d_sincos_pos_embed(self.hidden_size, [num_patches_height, num_patches_width])
-        pos_embed = nn.Parameter(torch.from_numpy(pos_embed).float().unsqueeze(0), requires_grad=False).to(x.device)
-
-        pos_embed_1d = get_2d_sincos_pos_embed(self.hidden_size, [num_tubes_length, 1])
-        pos_embed_1d = nn.Parameter(torch.from_numpy(pos_embed_1d).float().unsqueeze(0), requires_grad=False).to(x.device)
-
         # print(num_patches_height, num_patches_width, x.shape, pos_embed.shape)
         self.x_embedder.img_size = [H, W]
         x = rearrange(x, 'b d t h w -> (b t) d h w')
-        x = self.x_embedder(x) + pos_embed  # (BT, N, D), where N = H * W / patch_size ** 2
+        x = self.x_embedder(x)
+        pos_embed, pos_embed_1d = self.get_pos_embed(num_tubes_length, num_patches_height, num_patches_width,
+                                                     x.device, x.dtype)
+        x = x + pos_embed  # (BT, N, D), where N = H * W / patch_size ** 2
         x = rearrange(x, '(b t) n d -> (b n) t d', t=self.t)
         x = x + pos_embed_1d
         x = rearrange(x, '(b n) t d -> b (t n) d', b=B)
+        num_tokens = x.shape[1]
+        if self.sp_group is not None:
+            x, attention_mask = self.shard_sequence(x, attention_mask)
+        if attention_mask is not None:
+            # prepared once here instead of in every attention layer
+            attention_mask = KeyPaddingMask(attention_mask.flatten(1).bool())
+            if attention_mask.all_valid:
+                attention_mask = None
+
+        if cond_cache is not None:
+            c = cond_cache(t, y)                 # (B, D)
+        else:
+            t = self.t_embedder(t)               # (B, D)
+            y = self.y_embedder(y, self.training)  # (B, D)
+            c = t + y                            # (B, D)
+        grid_size = (self.t, self.h, self.w)
+        if self.batched_adaln and not torch.is_grad_enabled():
+            modulation, final_modulation = self.batched_modulation(c)
+        else:
+            modulation, final_modulation = [None] * len(self.blocks), None
+        if block_cache is None:
+            x = self._run_blocks(x, c, attention_mask, grid_size, modulation, 0, len(self.blocks))  # (B, N, D)
+        else:
+            # the residual of blocks [start, end) is either recomputed and cached, or reused from an earlier step
+            x = self._run_blocks(x, c, attention_mask, grid_size, modulation, 0, block_cache.start)
+            if block_cache.begin_step(x):
+                x = x + block_cache.residual
+            else:
+                x_start = x
+                x = self._run_blocks(x, c, attention_mask, grid_size, modulation, block_cache.start, block_cache.end)
+                block_cache.residual = x - x_start
+            x = self._run_blocks(x, c, attention_mask, grid_size, modulation, block_cache.end, len(self.blocks))
+        x = self.final_layer(x, c, None, final_modulation)  # (B, N, patch_size_t * patch_size ** 2 * out_channels)
+        if self.sp_group is not None:
+            x = self.gather_sequence(x, num_tokens)
+        x = self.unpatchify(x)                   # (B, out_channels, T, H, W)
+        return x
 
-        t = self.t_embedder(t)                   # (B, D)
-        y = self.y_embedder(y, self.training)    # (B, D)
-        c = t + y                                # (B, D)
-        for block in self.blocks:                  # (B, N, D)
+    def _run_blocks(self, x, c, attention_mask, grid_size, modulation, start, end):
+        """
+        Run blocks [start, end) of the padded forward pass.
+        """
+        for block, block_modulation in zip(self.blocks[start:end], modulation[start:end]):
             if self.gradient_checkpointing and self.training:
-                x = torch.utils.checkpoint.checkpoint(self.ckpt_wrapper(block), x, c, attention_mask)  # (B, N, D)
+                x = torch.utils.checkpoint.checkpoint(self.ckpt_wrapper(block), x, c, attention_mask, None, grid_size)  # (B, N, D)
             else:
-                x = block(x, c, attention_mask)
-        x = self.final_layer(x, c)                # (B, N, patch_size_t * patch_size ** 2 * out_channels)
-        x = self.unpatchify(x)                   # (B, out_channels, T, H, W)
+                x = block(x, c, attention_mask, None, grid_size, block_modulation)
         return x
 
-    def forward_with_cfg(self, x, t, y, cfg_scale, attention_mask):
+    def forward_packed(self, x, t, y, packing, cond_cache=None):
+        """
+        Forward pass of DiT over several clips packed into one token sequence (see videodata.PackedCollate).
+        Every token is treated as its own diffusion sample, so GaussianDiffusion works on packed batches as is.
+        x: (N, in_channels * patch_size_t * patch_size ** 2) tensor of the latent patches of all clips,
+           each patch flattened as (c, o, p, q)
+        t: (N,) tensor of diffusion timesteps, constant within a clip
+        y: (S,) tensor of class labels, one per clip
+        packing: dict with seq_ids (N,), the clip of every token, cu_seqlens (S + 1,), the token
+                 offsets of the clips, and grid_sizes, the (t, h, w) patch grid of every clip
+        cond_cache: optional ConditioningCache built for y
+        return: (N, out_channels * patch_size_t * patch_size ** 2) tensor in the patch layout of x
+        """
+        assert self.patch_size_t == 1, "Packed sequences need a 2D patch embedding."
+        assert self.sp_group is None, "Packed sequences do not support sequence parallelism."
+        w = self.x_embedder.proj.weight
+        x = F.linear(x, w.view(w.shape[0], -1), self.x_embedder.proj.bias)  # same as the strided conv, (N, D)
+        pos_embed = []
+        for num_tubes_length, num_patches_height, num_patches_width in packing['grid_sizes']:
+            pos, pos_1d = self.get_pos_embed(num_tubes_length, num_patches_height, num_patches_width, x.device, x.dtype)
+            pos_embed.append((pos_1d.transpose(0, 1) + pos).flatten(0, 1))  # (t, 1, D) + (1, h * w, D)
+        x = (x + torch.cat(pos_embed)).unsqueeze(0)  # (1, N, D)
+
+        # clips of equal length share one attention call unless flash-attn handles the packed sequence
+        seqlens = [t * h * w for t, h, w in packing['grid_sizes']]
+        offsets = np.cumsum([0] + seqlens[:-1]).tolist()
+        packing = dict(packing, groups=group_sequences([(o, 1, L) for o, L in zip(offsets, seqlens)], x.device))
+        if any(isinstance(block, FactorizedDiTBlock) for block in self.blocks):
+            packing = dict(packing, **get_factorized_packing(packing['grid_sizes'], x.device))
+
+        t = t[packing['cu_seqlens'][:-1].long()]
+        if cond_cache is not None:
+            c = cond_cache(t, y)                   # (S, D)
+        else:
+            t = self.t_embedder(t)                 # (S, D)
+            y = self.y_embedder(y, self.training)  # (S, D)
+            c = t + y                              # (S, D)
+        if self.batched_adaln and not torch.is_grad_enabled():
+            modulation, final_modulation = self.batched_modulation(c)
+        else:
+            modulation, final_modulation = [None] * len(self.blocks), None
+        for block, block_modulation in zip(self.blocks, modulation):
+            if self.gradient_checkpointing and self.training:
+                x = torch.utils.checkpoint.checkpoint(self.ckpt_wrapper(block), x, c, None, packing)
+            else:
+                x = block(x, c, None, packing, None, block_modulation)
+        x = self.final_layer(x, c, packing, final_modulation).squeeze(0)  # (N, patch_size_t * patch_size ** 2 * out_channels)
+        p = self.patch_size
+        x = x.reshape(x.shape[0], self.patch_size_t, p, p, self.out_channels)
+        return torch.einsum('nopqc->ncopq', x).reshape(x.shape[0], -1)
+
+    def forward_with_cfg(self, x, t, y, cfg_scale, attention_mask, cond_cache=None, block_cache=None):
         """
         Forward pass of DiT, but also batches the unconDiTional forward pass for classifier-free guidance.
         """
         # https://github.com/openai/glide-text2im/blob/main/notebooks/text2im.ipynb
         half = x[: len(x) // 2]
         combined = torch.cat([half, half], dim=0)
-        model_out = self.forward(combined, t, y, attention_mask)
+        model_out = self.forward(combined, t, y, attention_mask, cond_cache=cond_cache, block_cache=block_cache)
         # For exact reproducibility reasons, we apply classifier-free guidance on only
         # three channels by default. The standard approach to cfg applies it to all channels.
         # This can be done by uncommenting the following line and commenting-out the line following that.
@@ -365,11 +914,73 @@ class DiT(nn.Module):
         return torch.cat([eps, rest], dim=1)
 
 
+def get_factorized_packing(grid_sizes, device):
+    """
+    Packing metadata for FactorizedDiTBlock: cu_seqlens of every frame of every clip for spatial attention,
+    and the permutation that regroups the (t-major) tokens of every clip by patch location, with the
+    matching cu_seqlens, for temporal attention. Within a clip all frames, and all patch locations, are
+    equally long, so the group_sequences() of both batch every clip (and clips of the same grid) into
+    a single attention call.
+    """
+    spatial_seqlens, temporal_seqlens, temporal_perm = [], [], []
+    spatial_blocks, temporal_blocks = [], []
+    offset = 0
+    for t, h, w in grid_sizes:
+        spatial_seqlens += [h * w] * t
+        temporal_seqlens += [t] * (h * w)
+        temporal_perm.append(offset + torch.arange(t * h * w).view(t, h * w).t().flatten())
+        spatial_blocks.append((offset, t, h * w))
+        temporal_blocks.append((offset, h * w, t))  # in the temporal_perm order
+        offset += t * h * w
+    temporal_perm = torch.cat(temporal_perm).to(device)
+    return dict(
+        spatial_cu_seqlens=F.pad(torch.tensor(spatial_seqlens).cumsum(0), (1, 0)).to(device),
+        temporal_cu_seqlens=F.pad(torch.tensor(temporal_seqlens).cumsum(0), (1, 0)).to(device),
+        temporal_perm=temporal_perm,
+        temporal_perm_inv=torch.argsort(temporal_perm),
+        spatial_groups=group_sequences(spatial_blocks, device),
+        temporal_groups=group_sequences(temporal_blocks, device),
+    )
+
+
 #################################################################################
 #                   Sine/Cosine Positional Embedding Functions                  #
 #################################################################################
 # https://github.com/facebookresearch/mae/blob/main/util/pos_embed.py
 
+@lru_cache(maxsize=32)
+def get_cached_sincos_pos_embed(t, h, w, embed_dim, device, dtype):
+    """
+    LRU-cached, device-resident (1, h * w, D) spatial and (1, t, D) temporal sin-cos embeddings.
+    The returned tensors are shared between calls and must not be modified in place.
+    """
+    pos_embed = get_2d_sincos_pos_embed_torch(embed_dim, [h, w], device=device).to(dtype).unsqueeze(0)
+    pos_embed_1d = get_2d_sincos_pos_embed_torch(embed_dim, [t, 1], device=device).to(dtype).unsqueeze(0)
+    return pos_embed, pos_embed_1d
+
+
+def get_2d_sincos_pos_embed_torch(embed_dim, grid_size, device=None):
+    """
+    Vectorized torch version of get_2d_sincos_pos_embed(), computed in float64 on the target device.
+    return: (grid_size[0] * grid_size[1], embed_dim) tensor
+    """
+    assert embed_dim % 2 == 0
+    grid_h = torch.arange(grid_size[0], dtype=torch.float64, device=device)
+    grid_w = torch.arange(grid_size[1], dtype=torch.float64, device=device)
+    grid_h, grid_w = torch.meshgrid(grid_h, grid_w, indexing='ij')
+    # same order as get_2d_sincos_pos_embed_from_grid, where grid[0] holds the w coordinates
+    return torch.cat([get_1d_sincos_pos_embed_torch(embed_dim // 2, grid_w),
+                      get_1d_sincos_pos_embed_torch(embed_dim // 2, grid_h)], dim=1)
+
+
+def get_1d_sincos_pos_embed_torch(embed_dim, pos):
+    assert embed_dim % 2 == 0
+    omega = torch.arange(embed_dim // 2, dtype=torch.float64, device=pos.device) / (embed_dim / 2.)
+    omega = 1. / 10000 ** omega  # (D/2,)
+    out = pos.reshape(-1, 1) * omega[None]  # (M, D/2), outer product
+    return torch.cat([torch.sin(out), torch.cos(out)], dim=1)  # (M, D)
+
+
 def get_2d_sincos_pos_embed(embed_dim, grid_size, cls_token=False, extra_tokens=0):
     """
     grid_size: int of the grid height and width
@@ -463,9 +1074,51 @@ def DiT_S_188(**kwargs):
     return DiT(depth=12, hidden_size=384, patch_size_t=1, patch_size=8, num_heads=6, **kwargs)
 
 
+def DiT_XL_ST_122(**kwargs):
+    return DiT(depth=28, hidden_size=1152, patch_size_t=1, patch_size=2, num_heads=16, full_attn_every=4, **kwargs)
+
+def DiT_XL_ST_144(**kwargs):
+    return DiT(depth=28, hidden_size=1152, patch_size_t=1, patch_size=4, num_heads=16, full_attn_every=4, **kwargs)
+
+def DiT_XL_ST_188(**kwargs):
+    return DiT(depth=28, hidden_size=1152, patch_size_t=1, patch_size=8, num_heads=16, full_attn_every=4, **kwargs)
+
+def DiT_L_ST_122(**kwargs):
+    return DiT(depth=24, hidden_size=1024, patch_size_t=1, patch_size=2, num_heads=16, full_attn_every=4, **kwargs)
+
+def DiT_L_ST_144(**kwargs):
+    return DiT(depth=24, hidden_size=1024, patch_size_t=1, patch_size=4, num_heads=16, full_attn_every=4, **kwargs)
+
+def DiT_L_ST_188(**kwargs):
+    return DiT(depth=24, hidden_size=1024, patch_size_t=1, patch_size=8, num_heads=16, full_attn_every=4, **kwargs)
+
+def DiT_B_ST_122(**kwargs):
+    return DiT(depth=12, hidden_size=768, patch_size_t=1, patch_size=2, num_heads=12, full_attn_every=4, **kwargs)
+
+def DiT_B_ST_144(**kwargs):
+    return DiT(depth=12, hidden_size=768, patch_size_t=1, patch_size=4, num_heads=12, full_attn_every=4, **kwargs)
+
+def DiT_B_ST_188(**kwargs):
+    return DiT(depth=12, hidden_size=768, patch_size_t=1, patch_size=8, num_heads=12, full_attn_every=4, **kwargs)
+
+def DiT_S_ST_122(**kwargs):
+    return DiT(depth=12, hidden_size=384, patch_size_t=1, patch_size=2, num_heads=6, full_attn_every=4, **kwargs)
+
+def DiT_S_ST_144(**kwargs):
+    return DiT(depth=12, hidden_size=384, patch_size_t=1, patch_size=4, num_heads=6, full_attn_every=4, **kwargs)
+
+def DiT_S_ST_188(**kwargs):
+    return DiT(depth=12, hidden_size=384, patch_size_t=1, patch_size=8, num_heads=6, full_attn_every=4, **kwargs)
+
+
 DiT_models = {
     'DiT-XL/122': DiT_XL_122,  'DiT-XL/144': DiT_XL_144,  'DiT-XL/188': DiT_XL_188,
     'DiT-L/122':  DiT_L_122,   'DiT-L/144':  DiT_L_144,   'DiT-L/188':  DiT_L_188,
     'DiT-B/122':  DiT_B_122,   'DiT-B/144':  DiT_B_144,   'DiT-B/188':  DiT_B_188,
     'DiT-S/122':  DiT_S_122,   'DiT-S/144':  DiT_S_144,   'DiT-S/188':  DiT_S_188,
+    # factorized spatial/temporal attention, with full attention in every 4th block
+    'DiT-XL-ST/122': DiT_XL_ST_122,  'DiT-XL-ST/144': DiT_XL_ST_144,  'DiT-XL-ST/188': DiT_XL_ST_188,
+    'DiT-L-ST/122':  DiT_L_ST_122,   'DiT-L-ST/144':  DiT_L_ST_144,   'DiT-L-ST/188':  DiT_L_ST_188,
+    'DiT-B-ST/122':  DiT_B_ST_122,   'DiT-B-ST/144':  DiT_B_ST_144,   'DiT-B-ST/188':  DiT_B_ST_188,
+    'DiT-S-ST/122':  DiT_S_ST_122,   'DiT-S-ST/144':  DiT_S_ST_144,   'DiT-S-ST/188':  DiT_S_ST_188,
 }
@@ -0,0 +1,166 @@
+"""
+Streaming previews of DiT sampling.
+
+PreviewStream wraps any *_sample_loop_progressive generator and turns the
+pred_xstart of every k-th step into a small RGB video. A linear latent-to-RGB
+projection (see fit_latent_rgb_projection) costs almost nothing. A full VQ-VAE
+decode is optional. Either way the work runs in a background thread on its
+own CUDA stream, so the sampling loop never waits for a preview.
+"""
+import queue
+import threading
+
+import torch
+from torch.nn import functional as F
+
+
+@torch.no_grad()
+def fit_latent_rgb_projection(vae, videos):
+    """
+    Least-squares fit of a linear map from VQ-VAE latents to RGB.
+    The map is fitted against the videos downsampled to the latent grid, so a
+    preview is one small matmul per latent voxel.
+    :param vae: the VideoGPT VQ-VAE the DiT latents come from.
+    :param videos: (B, 3, T, H, W) tensor of videos, normalized like the training data.
+    :return: a tuple (weight, bias), a (3, C) and a (3,) tensor.
+    """
+    latents = vae.pre_vq_conv(vae.encoder(videos))                           # (B, C, t, h, w)
+    targets = F.adaptive_avg_pool3d(videos, latents.shape[2:])               # (B, 3, t, h, w)
+    a = latents.transpose(0, 1).flatten(1).t().double()                      # (M, C)
+    a = torch.cat([a, torch.ones_like(a[:, :1])], dim=1)                     # (M, C + 1)
+    b = targets.transpose(0, 1).flatten(1).t().double()                      # (M, 3)
+    solution = torch.linalg.lstsq(a.cpu(), b.cpu()).solution.t().float()     # (3, C + 1)
+    return solution[:, :-1].contiguous(), solution[:, -1].contiguous()
+
+
+@torch.no_grad()
+def decode_latents(vae, latents):
+    """
+    Full VQ-VAE decode of (B, C, t, h, w) pre-quantization latents into (B, 3, T, H, W) videos.
+    """
+    assert not vae.training, "call vae.eval() first, the codebook updates itself in training mode"
+    return vae.decoder(vae.post_vq_conv(vae.codebook(latents)['embeddings']))
+
+
+def to_uint8_video(x):
+    """
+    (B, 3, T, H, W) videos normalized to [-0.5, 0.5] -> (B, T, H, W, 3) uint8 tensor.
+    """
+    return ((x + 0.5).clamp(0, 1) * 255).round().to(torch.uint8).permute(0, 2, 3, 4, 1)
+
+
+class PreviewStream:
+    """
+    Renders previews of the pred_xstart of every `every`-th sampling step in a background thread.
+    Use wrap() around a progressive sampling loop and read the finished previews from get() or by
+    iterating over the stream, as (step, (B, T, H, W, 3) uint8 CPU tensor) tuples.
+    The sampling loop never blocks: when `max_pending` previews are still waiting to be rendered,
+    new ones are skipped. The final step is always previewed.
+    :param weight: (3, C) latent-to-RGB projection, see fit_latent_rgb_projection().
+    :param bias: (3,) bias of the projection.
+    :param every: the number of sampling steps between previews.
+    :param max_size: if specified, downsample the latent grid to at most this height and width
+                     before projecting.
+    :param vae: if specified, decode the previews with the VQ-VAE instead of the linear projection.
+    :param max_pending: the number of submitted previews that may wait for the worker.
+    """
+
+    def __init__(self, weight=None, bias=None, every=10, max_size=None, vae=None, max_pending=2):
+        assert weight is not None or vae is not None, "pass a latent-to-RGB projection or a VQ-VAE"
+        self.weight = weight
+        self.bias = bias
+        self.every = every
+        self.max_size = max_size
+        self.vae = vae
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._previews = queue.Queue()
+        self._stream = None
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def wrap(self, progressive):
+        """
+        Pass the outputs of a *_sample_loop_progressive generator through and preview every
+        `every`-th step. Closes the stream once the loop is exhausted.
+        """
+        out, step = None, -1
+        for step, out in enumerate(progressive):
+            if step % self.every == 0:
+                self.submit(step, out["pred_xstart"])
+            yield out
+        if out is not None and step % self.every != 0:
+            self.submit(step, out["pred_xstart"], block=True)
+        self.close()
+
+    def submit(self, step, latents, block=False):
+        """
+        Queue (B, C, t, h, w) latents for a preview, skipping it if the worker is behind.
+        The latents must not be modified in place afterwards; the sampling loops create new
+        tensors every step, so no copy is made.
+        """
+        event = None
+        if latents.is_cuda:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(latents.device))
+        try:
+            self._pending.put((step, latents, event), block=block)
+        except queue.Full:
+            pass
+
+    def close(self):
+        """
+        Finish the queued previews and stop the worker; get() returns None once all are read.
+        """
+        self._pending.put(None)
+
+    def get(self, timeout=None):
+        """
+        Get the next finished preview as (step, video), or None once the stream is closed.
+        """
+        return self._previews.get(timeout=timeout)
+
+    def __iter__(self):
+        while True:
+            preview = self.get()
+            if preview is None:
+                return
+            yield preview
+
+    @torch.no_grad()
+    def render(self, latents):
+        """
+        Render (B, C, t, h, w) latents into a (B, t, h, w, 3) uint8 preview on the latents' device.
+        """
+        if self.vae is not None:
+            return to_uint8_video(decode_latents(self.vae, latents))
+        latents = latents.float()
+        if self.max_size is not None and max(latents.shape[-2:]) > self.max_size:
+            t, h, w = latents.shape[2:]
+            scale = self.max_size / max(h, w)
+            size = (t, max(1, int(h * scale)), max(1, int(w * scale)))
+            latents = F.adaptive_avg_pool3d(latents, size)
+        weight = self.weight.to(latents.device)
+        rgb = torch.einsum('bcthw,kc->bkthw', latents, weight)
+        if self.bias is not None:
+            rgb = rgb + self.bias.to(latents.device).view(1, -1, 1, 1, 1)
+        return to_uint8_video(rgb)
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            step, latents, event = item
+            if event is not None:
+                if self._stream is None:
+                    self._stream = torch.cuda.Stream(latents.device)
+                with torch.cuda.stream(self._stream):
+                    # wait for the sampling step that produced the latents, and keep the allocator
+                    # from reusing their memory until the preview is rendered
+                    self._stream.wait_event(event)
+                    latents.record_stream(self._stream)
+                    preview = self.render(latents).cpu()
+            else:
+                preview = self.render(latents)
+            self._previews.put((step, preview))
+        self._previews.put(None)
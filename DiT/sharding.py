@@ -0,0 +1,81 @@
+"""
+Sharded data parallelism (FSDP, i.e. ZeRO-2/3) for DiT training.
+
+shard_model() wraps every DiT block in its own FSDP unit, so only one block is
+gathered at a time, and shards parameters, gradients and optimizer state over
+all ranks. The EMA copy is wrapped the same way and averages its local shards
+(see ema.EMA). Checkpoints hold only each rank's own shards, written as
+rank-local state by checkpointing.AsyncCheckpointer. Nothing here assumes
+CUDA, so everything also runs on CPU with the gloo backend.
+"""
+import functools
+import itertools
+
+import torch
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP, FullStateDictConfig, ShardingStrategy, \
+    StateDictType
+from torch.distributed.fsdp.wrap import transformer_auto_wrap_policy
+
+from models import DiTBlock, FactorizedDiTBlock
+
+SHARDING_STRATEGIES = {"zero2": ShardingStrategy.SHARD_GRAD_OP, "zero3": ShardingStrategy.FULL_SHARD}
+
+
+def shard_model(model, device=None, strategy="zero3", **kwargs):
+    """
+    Wrap a DiT in FSDP, with one unit per DiT block and the root unit holding the embedders and the final layer.
+    Rank 0's weights are broadcast to all ranks, like DDP does.
+    :param model: the DiT to shard.
+    :param device: the device to train on, None or a CPU device to stay on the CPU (e.g. with gloo).
+    :param strategy: "zero3" shards the parameters, "zero2" keeps them gathered between forward and backward.
+    :param kwargs: extra arguments for FullyShardedDataParallel.
+    """
+    policy = functools.partial(transformer_auto_wrap_policy, transformer_layer_cls={DiTBlock, FactorizedDiTBlock})
+    if device is not None and torch.device(device).type == "cuda":
+        kwargs.setdefault("device_id", torch.device(device))
+    # the original parameters stay visible (as views of the local shard) for the optimizer, EMA and torch.compile
+    return FSDP(model, auto_wrap_policy=policy, sharding_strategy=SHARDING_STRATEGIES[strategy],
+                use_orig_params=True, sync_module_states=True, **kwargs)
+
+
+def local_state_dict(module):
+    """
+    The rank-local parameter shards and the buffers of an FSDP module, as plain tensors.
+    These are views of the live shards, the checkpointer copies them.
+    """
+    return {name: t.detach() for name, t in itertools.chain(module.named_parameters(), module.named_buffers())}
+
+
+@torch.no_grad()
+def load_local_state_dict(module, state_dict):
+    """
+    Load a local_state_dict() saved by the same rank with the same world size.
+    """
+    for name, t in itertools.chain(module.named_parameters(), module.named_buffers()):
+        t.copy_(state_dict[name])
+
+
+def full_state_dict(module):
+    """
+    Gather the full state dict of an FSDP module on the CPU of rank 0, e.g. to export the EMA for sampling.
+    Must be called on all ranks, the other ranks get an empty dict.
+    """
+    config = FullStateDictConfig(offload_to_cpu=True, rank0_only=True)
+    with FSDP.state_dict_type(module, StateDictType.FULL_STATE_DICT, config):
+        return module.state_dict()
+
+
+def sharded_state_dict(model, ema, opt):
+    """
+    The rank-local training state, for AsyncCheckpointer.save(..., replicated=False).
+    """
+    return {"model": local_state_dict(model), "ema": local_state_dict(ema), "opt": opt.state_dict()}
+
+
+def load_sharded_state_dict(checkpoint, model, ema, opt):
+    """
+    Load the rank-local state of sharded_state_dict() into model, ema and opt.
+    """
+    load_local_state_dict(model, checkpoint["model"])
+    load_local_state_dict(ema, checkpoint["ema"])
+    opt.load_state_dict(checkpoint["opt"])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the DiT modules import each other as top-level modules, like the training scripts run from DiT/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
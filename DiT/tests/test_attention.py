@@ -0,0 +1,108 @@
+import pytest
+import torch
+
+from models import FactorizedDiTBlock, KeyPaddingMask, get_factorized_packing, group_sequences, masked_attention, \
+    varlen_attention
+
+
+def dense_masked_attention(q, k, v, mask):
+    """
+    The original dense attention of a padded batch: an additive (N x N) mask built as m @ m^T.
+    """
+    attn = (q * q.shape[-1] ** -0.5) @ k.transpose(-2, -1)
+    mask = mask.to(attn.dtype).flatten(1).unsqueeze(-1)
+    mask = (mask @ mask.transpose(1, 2)).unsqueeze(1)
+    attn = attn + mask.masked_fill(mask == 0, torch.finfo(attn.dtype).min)
+    return attn.softmax(dim=-1) @ v
+
+
+def random_padding_mask(B, N, generator):
+    lengths = torch.randint(1, N + 1, (B,), generator=generator)
+    lengths[0] = N  # one unpadded sample
+    return torch.arange(N)[None] < lengths[:, None]
+
+
+@pytest.mark.parametrize("fused", [True, False])
+@pytest.mark.parametrize("seed", range(3))
+def test_masked_attention_matches_dense(fused, seed):
+    g = torch.Generator().manual_seed(seed)
+    B, H, N, d = 4, 3, 17, 8
+    q, k, v = [torch.randn(B, H, N, d, generator=g, dtype=torch.float64) for _ in range(3)]
+    mask = random_padding_mask(B, N, g)
+
+    out = masked_attention(q, k, v, KeyPaddingMask(mask), fused=fused)
+    ref = dense_masked_attention(q, k, v, mask)
+
+    valid = mask[:, None, :, None].expand_as(out)
+    # the unfused path takes its softmax in float32
+    tolerance = {} if fused else dict(atol=1e-6, rtol=1e-5)
+    torch.testing.assert_close(out[valid], ref[valid], **tolerance)
+    assert (out[~valid] == 0).all()
+
+
+@pytest.mark.parametrize("fused", [True, False])
+def test_masked_attention_fully_padded_rows(fused):
+    # factorized attention produces rows without any valid token, e.g. padded frames
+    g = torch.Generator().manual_seed(0)
+    B, H, N, d = 3, 2, 5, 4
+    q, k, v = [torch.randn(B, H, N, d, generator=g) for _ in range(3)]
+    mask = torch.tensor([[True] * N, [False] * N, [True, True, False, False, False]])
+
+    out = masked_attention(q, k, v, KeyPaddingMask(mask), fused=fused)
+
+    assert torch.isfinite(out).all()
+    assert (out[1] == 0).all()
+    ref = dense_masked_attention(q[2:], k[2:], v[2:], mask[2:])
+    torch.testing.assert_close(out[2, :, :2], ref[0, :, :2])
+
+
+def test_unpadded_mask_is_dense_attention():
+    g = torch.Generator().manual_seed(0)
+    q, k, v = [torch.randn(2, 2, 6, 4, generator=g) for _ in range(3)]
+    mask = KeyPaddingMask(torch.ones(2, 6, dtype=torch.bool))
+    assert mask.all_valid
+    torch.testing.assert_close(masked_attention(q, k, v, mask, fused=False),
+                               torch.nn.functional.scaled_dot_product_attention(q, k, v))
+
+
+@pytest.mark.parametrize("fused", [True, False])
+def test_grouped_varlen_attention_matches_per_sequence(fused):
+    g = torch.Generator().manual_seed(0)
+    # back-to-back blocks of S sequences of length L, with repeated and distinct lengths
+    blocks, seqlens, offset = [], [], 0
+    for S, L in [(3, 4), (2, 7), (1, 4), (4, 1), (2, 7)]:
+        blocks.append((offset, S, L))
+        seqlens += [L] * S
+        offset += S * L
+    cu_seqlens = torch.nn.functional.pad(torch.tensor(seqlens).cumsum(0), (1, 0))
+    q, k, v = [torch.randn(1, 2, offset, 8, generator=g, dtype=torch.float64) for _ in range(3)]
+
+    out = varlen_attention(q, k, v, cu_seqlens, fused=fused, groups=group_sequences(blocks, q.device))
+    ref = varlen_attention(q, k, v, cu_seqlens, fused=fused)
+
+    torch.testing.assert_close(out, ref)
+
+
+def test_packed_factorized_block_matches_per_clip():
+    torch.manual_seed(0)
+    D = 32
+    block = FactorizedDiTBlock(D, num_heads=4).double().eval()
+    for p in block.parameters():  # adaLN-Zero would make the block an identity
+        torch.nn.init.normal_(p, std=0.1)
+    grid_sizes = [[2, 3, 3], [2, 3, 3], [3, 2, 4]]
+    clips = [torch.randn(1, t * h * w, D, dtype=torch.float64) for t, h, w in grid_sizes]
+    c = torch.randn(len(clips), D, dtype=torch.float64)
+
+    seqlens = torch.tensor([x.shape[1] for x in clips])
+    packing = dict(
+        seq_ids=torch.repeat_interleave(torch.arange(len(clips)), seqlens),
+        cu_seqlens=torch.nn.functional.pad(seqlens.cumsum(0), (1, 0)).to(torch.int32),
+        grid_sizes=grid_sizes,
+    )
+    packing.update(get_factorized_packing(grid_sizes, torch.device("cpu")))
+
+    out = block(torch.cat(clips, dim=1), c, None, packing)
+    ref = torch.cat([block(x, c[i:i + 1], None, None, grid_size)
+                     for i, (x, grid_size) in enumerate(zip(clips, grid_sizes))], dim=1)
+
+    torch.testing.assert_close(out, ref)
@@ -0,0 +1,18 @@
+import torch
+
+from models import DiT
+
+
+def test_conditioning_cache_matches_embedders():
+    torch.manual_seed(0)
+    model = DiT(input_size=8, patch_size=2, in_channels=4, hidden_size=32, depth=1, num_heads=4,
+                num_classes=10).eval()
+    y = torch.tensor([3, 7, 10])  # 10 is the null label of classifier-free guidance
+    cache = model.conditioning_cache([0, 250, 500, 999], y)
+
+    # timesteps of the schedule, and timesteps outside of it, which are embedded directly
+    for t in ([0, 500, 999], [1, 250, 500], [600, 1000, 2000]):
+        t = torch.tensor(t)
+        with torch.no_grad():
+            expected = model.t_embedder(t) + model.y_embedder(y, train=False)
+        torch.testing.assert_close(cache(t, y), expected)
@@ -0,0 +1,83 @@
+import copy
+
+import pytest
+import torch
+
+from models import DiTBlock, FactorizedDiTBlock, FinalLayer
+
+# on CUDA with triton installed the fused path runs the Triton kernel, otherwise the PyTorch fallback
+DEVICES = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+TOLERANCES = {torch.float32: dict(atol=1e-5, rtol=1e-4), torch.bfloat16: dict(atol=5e-2, rtol=5e-2)}
+D = 32
+GRID_SIZE = [2, 3, 4]
+
+
+def make_layer(kind):
+    if kind == "DiTBlock":
+        layer = DiTBlock(D, num_heads=4)
+    elif kind == "FactorizedDiTBlock":
+        layer = FactorizedDiTBlock(D, num_heads=4)
+    else:
+        layer = FinalLayer(D, patch_size_t=1, patch_size=2, out_channels=3)
+    for p in layer.parameters():  # adaLN-Zero would make the blocks an identity
+        torch.nn.init.normal_(p, std=0.1)
+    return layer.eval()
+
+
+def run(layer, kind, x, c):
+    if kind == "FinalLayer":
+        return layer(x, c)
+    return layer(x, c, None, None, GRID_SIZE)
+
+
+def reference_and_fused(kind, device, dtype):
+    torch.manual_seed(0)
+    reference = make_layer(kind).to(device, dtype)
+    fused = copy.deepcopy(reference)
+    fused.fused_adaln = True
+    return reference, fused
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("kind", ["DiTBlock", "FactorizedDiTBlock", "FinalLayer"])
+def test_fused_adaln_matches_reference(kind, dtype, device):
+    reference, fused = reference_and_fused(kind, device, dtype)
+    x = torch.randn(2, 24, D, device=device, dtype=dtype)
+    c = torch.randn(2, D, device=device, dtype=dtype)
+
+    with torch.no_grad():
+        torch.testing.assert_close(run(fused, kind, x, c), run(reference, kind, x, c), **TOLERANCES[dtype])
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("kind", ["DiTBlock", "FactorizedDiTBlock", "FinalLayer"])
+def test_fused_adaln_gradients_match_reference(kind, device):
+    reference, fused = reference_and_fused(kind, device, torch.float32)
+    x = torch.randn(2, 24, D, device=device)
+    c = torch.randn(2, D, device=device)
+
+    grads = []
+    for layer in (reference, fused):
+        inputs = [x.clone().requires_grad_(), c.clone().requires_grad_()]
+        run(layer, kind, *inputs).square().sum().backward()
+        grads.append([t.grad for t in inputs] + [p.grad for p in layer.parameters()])
+    for ref_grad, fused_grad in zip(*grads):
+        torch.testing.assert_close(fused_grad, ref_grad, **TOLERANCES[torch.float32])
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_fused_adaln_matches_reference_packed(dtype, device):
+    # packed sequences modulate every token with its own sample's (1, N, D) shift and scale
+    reference, fused = reference_and_fused("DiTBlock", device, dtype)
+    seqlens = torch.tensor([5, 11, 8])
+    packing = dict(
+        seq_ids=torch.repeat_interleave(torch.arange(len(seqlens)), seqlens).to(device),
+        cu_seqlens=torch.nn.functional.pad(seqlens.cumsum(0), (1, 0)).to(device, torch.int32),
+    )
+    x = torch.randn(1, int(seqlens.sum()), D, device=device, dtype=dtype)
+    c = torch.randn(len(seqlens), D, device=device, dtype=dtype)
+
+    with torch.no_grad():
+        torch.testing.assert_close(fused(x, c, None, packing), reference(x, c, None, packing), **TOLERANCES[dtype])
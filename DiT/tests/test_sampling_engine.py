@@ -0,0 +1,57 @@
+import torch
+
+from diffusion import SamplingEngine, SamplingRequest, create_diffusion
+from models import DiT
+
+SHAPE = (4, 2, 8, 8)
+
+
+def tiny_dit():
+    torch.manual_seed(0)
+    model = DiT(input_size=8, patch_size=2, in_channels=4, hidden_size=32, depth=2, num_heads=4, num_classes=10)
+    for p in model.parameters():  # adaLN-Zero would make every block an identity
+        torch.nn.init.normal_(p, std=0.02)
+    return model.eval()
+
+
+def reference_sample(model, request):
+    """
+    The same request sampled alone with ddim_sample_loop, guided by DiT.forward_with_cfg.
+    """
+    diffusion = create_diffusion(str(request.num_steps))
+    noise, y = request.noise[None], torch.tensor([request.y])
+    with torch.no_grad():
+        if request.cfg_scale == 1.0:
+            return diffusion.ddim_sample_loop(model.forward, noise.shape, noise=noise, clip_denoised=False,
+                                              model_kwargs=dict(y=y), device=noise.device)[0]
+        noise, y = torch.cat([noise, noise]), torch.cat([y, torch.tensor([model.y_embedder.num_classes])])
+        model_kwargs = dict(y=y, cfg_scale=request.cfg_scale, attention_mask=None)
+        return diffusion.ddim_sample_loop(model.forward_with_cfg, noise.shape, noise=noise, clip_denoised=False,
+                                          model_kwargs=model_kwargs, device=noise.device)[0]
+
+
+def test_continuous_batching_matches_sample_loop():
+    model = tiny_dit()
+    g = torch.Generator().manual_seed(1)
+    # guided requests take two rows: the third request only joins once the second one finishes,
+    # and the fourth, submitted while the engine runs, once the first one does
+    requests = [
+        SamplingRequest(SHAPE, y=1, num_steps=5, noise=torch.randn(SHAPE, generator=g)),
+        SamplingRequest(SHAPE, y=2, num_steps=3, cfg_scale=4.0, noise=torch.randn(SHAPE, generator=g)),
+        SamplingRequest(SHAPE, y=3, num_steps=4, cfg_scale=2.0, noise=torch.randn(SHAPE, generator=g)),
+        SamplingRequest(SHAPE, y=4, num_steps=2, noise=torch.randn(SHAPE, generator=g)),
+    ]
+    engine = SamplingEngine(model, max_batch_size=3)
+    for request in requests[:3]:
+        engine.submit(request)
+
+    finished = []
+    for request in engine.run():
+        finished.append(request)
+        if len(finished) == 1:
+            engine.submit(requests[3])
+
+    assert [r.y for r in finished] == [2, 1, 3, 4]
+    for request in requests:
+        assert request.done
+        torch.testing.assert_close(request.sample, reference_sample(model, request), atol=1e-4, rtol=1e-4)
@@ -0,0 +1,60 @@
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from diffusion import create_diffusion
+from models import DiT, head_to_sequence_shard, sequence_to_head_shard
+
+WORLD_SIZE = 2
+
+
+def tiny_dit():
+    torch.manual_seed(0)
+    model = DiT(input_size=8, patch_size=2, in_channels=4, hidden_size=32, depth=2, num_heads=4, num_classes=10)
+    for p in model.parameters():  # adaLN-Zero would make every block an identity
+        torch.nn.init.normal_(p, std=0.02)
+    return model.eval()
+
+
+def _check_sequence_parallel(rank, init_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+    try:
+        # the Ulysses all-to-all trades sequence shards for head shards and back
+        x = torch.randn(2, 4, 6 * WORLD_SIZE, 8, generator=torch.Generator().manual_seed(0))
+        heads = x.shape[1] // WORLD_SIZE
+        seq_shard = x.chunk(WORLD_SIZE, dim=2)[rank]
+        head_shard = sequence_to_head_shard(seq_shard, dist.group.WORLD)
+        torch.testing.assert_close(head_shard, x[:, rank * heads:(rank + 1) * heads], rtol=0, atol=0)
+        torch.testing.assert_close(head_to_sequence_shard(head_shard, dist.group.WORLD), seq_shard, rtol=0, atol=0)
+
+        model = tiny_dit()
+        g = torch.Generator().manual_seed(1)
+        x, t, y = torch.randn(2, 4, 3, 8, 8, generator=g), torch.randint(0, 1000, (2,), generator=g), \
+            torch.randint(0, 10, (2,), generator=g)
+        with torch.no_grad():
+            ref = model(x, t, y)
+            model.enable_sequence_parallel()
+            torch.testing.assert_close(model(x, t, y), ref, atol=1e-5, rtol=1e-4)
+
+            # ranks with different random states sample from the first rank's noise, the loop arguments
+            # are passed positionally: shape, noise, clip_denoised, denoised_fn, cond_fn, model_kwargs, device
+            diffusion = create_diffusion("5")
+            torch.manual_seed(100 + rank)
+            *_, out = diffusion.ddim_sample_loop_progressive(model.forward, tuple(x.shape), None, False, None, None,
+                                                             dict(y=y), x.device)
+            samples = [torch.empty_like(out["sample"]) for _ in range(WORLD_SIZE)]
+            dist.all_gather(samples, out["sample"])
+            for sample in samples[1:]:
+                torch.testing.assert_close(sample, samples[0], rtol=0, atol=0)
+
+            model.disable_sequence_parallel()
+            torch.manual_seed(100)
+            ref = diffusion.ddim_sample_loop(model.forward, tuple(x.shape), clip_denoised=False,
+                                             model_kwargs=dict(y=y), device=x.device)
+            torch.testing.assert_close(out["sample"], ref, atol=1e-4, rtol=1e-4)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_sequence_parallel_gloo(tmp_path):
+    mp.spawn(_check_sequence_parallel, args=(str(tmp_path / "store"),), nprocs=WORLD_SIZE)
@@ -11,15 +11,16 @@ import torch
 # the first flag below was False when we tested this script but True makes A100 training a lot faster:
 from torch import nn
 from videogpt import load_vqvae
-from videodata import Collate, UCF101ClassConditionedDataset
+from videodata import Collate, UCF101ClassConditionedDataset, LatentCollate, LatentDataset, update_video_index, \
+    DistributedBucketBatchSampler, PackedCollate, ResumableDistributedSampler, slice_packing
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
 import torch.distributed as dist
+from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader
-from torch.utils.data.distributed import DistributedSampler
-from collections import OrderedDict
+from contextlib import nullcontext
 from copy import deepcopy
 from glob import glob
 from time import time
@@ -28,24 +29,75 @@ import logging
 import os
 
 from models import DiT_models
+from ema import EMA
+from sharding import SHARDING_STRATEGIES, shard_model, sharded_state_dict, load_sharded_state_dict
+from checkpointing import AsyncCheckpointer, load_checkpoint, resolve_checkpoint, rng_state, set_rng_state
 from diffusion import create_diffusion
+from diffusion.timestep_sampler import create_named_schedule_sampler, LossAwareSampler
 
 
 #################################################################################
 #                             Training Helper Functions                         #
 #################################################################################
 
-@torch.no_grad()
-def update_ema(ema_model, model, decay=0.9999):
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast_forward(model, dtype, device_type="cuda"):
     """
-    Step the EMA model towards the current model.
+    Run the forward of model under autocast and return fp32 outputs, so the parameters stay fp32 master
+    weights and the diffusion losses are computed in full precision.
     """
-    ema_params = OrderedDict(ema_model.named_parameters())
-    model_params = OrderedDict(model.named_parameters())
+    if dtype == torch.float32:
+        return model
 
-    for name, param in model_params.items():
-        # TODO: Consider applying only to params that require_grad to avoid small numerical changes of pos_embed
-        ema_params[name].mul_(decay).add_(param.data, alpha=1 - decay)
+    def forward(*args, **kwargs):
+        with torch.autocast(device_type=device_type, dtype=dtype):
+            out = model(*args, **kwargs)
+        return out.float()
+    return forward
+
+
+def micro_batch_ranges(clip_tokens, token_budget=None, min_micro_batches=1):
+    """
+    Split a batch into micro-batches of consecutive clips with at most token_budget tokens each
+    (a clip longer than the budget is a micro-batch of its own), and at least min_micro_batches of them.
+    :param clip_tokens: the number of tokens of every clip in the batch.
+    :return: a list of (start, end) clip ranges.
+    """
+    ranges, start, tokens = [], 0, 0
+    if token_budget is not None:
+        for i, n in enumerate(clip_tokens):
+            if i > start and tokens + n > token_budget:
+                ranges.append((start, i))
+                start, tokens = i, 0
+            tokens += n
+    ranges.append((start, len(clip_tokens)))
+    return split_micro_batches(ranges, min_micro_batches)
+
+
+def split_micro_batches(ranges, num_micro_batches):
+    """
+    Halve the largest micro-batches until there are num_micro_batches of them, or each holds a single clip.
+    """
+    ranges = list(ranges)
+    while len(ranges) < num_micro_batches:
+        i = max(range(len(ranges)), key=lambda i: ranges[i][1] - ranges[i][0])
+        start, end = ranges[i]
+        if end - start < 2:
+            break
+        ranges[i:i + 1] = [(start, (start + end) // 2), ((start + end) // 2, end)]
+    return ranges
+
+
+def packed_clip_mean(values, packing):
+    """
+    Average per-token values of packed clips per clip.
+    """
+    cu_seqlens = packing['cu_seqlens'].long()
+    per_clip = torch.zeros(len(cu_seqlens) - 1, device=values.device, dtype=values.dtype)
+    per_clip.index_add_(0, packing['seq_ids'], values)
+    return per_clip / (cu_seqlens[1:] - cu_seqlens[:-1])
 
 
 def requires_grad(model, flag=True):
@@ -88,31 +140,43 @@ def main(args):
     """
     Trains a new DiT model.
     """
-    assert torch.cuda.is_available(), "Training currently requires at least one GPU."
-
-    # Setup DDP:
-    dist.init_process_group("nccl")
+    # Setup DDP, on GPUs with NCCL, or without any on the CPU with gloo (e.g. to test sharded training):
+    use_cuda = torch.cuda.is_available()
+    device_type = "cuda" if use_cuda else "cpu"
+    dist.init_process_group("nccl" if use_cuda else "gloo")
     assert args.global_batch_size % dist.get_world_size() == 0, f"Batch size must be divisible by world size."
+    assert use_cuda or args.precision != "fp16", "fp16 training needs a GPU."
     rank = dist.get_rank()
-    device = rank % torch.cuda.device_count()
+    device = rank % torch.cuda.device_count() if use_cuda else torch.device("cpu")
     seed = args.global_seed * dist.get_world_size() + rank
     torch.manual_seed(seed)
-    torch.cuda.set_device(device)
+    if use_cuda:
+        torch.cuda.set_device(device)
     print(f"Starting rank={rank}, seed={seed}, world_size={dist.get_world_size()}.")
 
     # Setup an experiment folder:
+    resume_path = resolve_checkpoint(args.resume) if args.resume is not None else None
     if rank == 0:
         print(args)
-        os.makedirs(args.results_dir, exist_ok=True)  # Make results folder (holds all experiment subfolders)
-        experiment_index = len(glob(f"{args.results_dir}/*"))
-        model_string_name = args.model.replace("/", "-")  # e.g., DiT-XL/2 --> DiT-XL-2 (for naming folders)
-        experiment_dir = f"{args.results_dir}/{experiment_index:03d}-{model_string_name}"  # Create an experiment folder
+        if resume_path is not None:
+            # continue in the experiment folder of the checkpoint: <experiment_dir>/checkpoints/<step>
+            experiment_dir = os.path.dirname(os.path.dirname(os.path.abspath(resume_path)))
+        else:
+            os.makedirs(args.results_dir, exist_ok=True)  # Make results folder (holds all experiment subfolders)
+            experiment_index = len(glob(f"{args.results_dir}/*"))
+            model_string_name = args.model.replace("/", "-")  # e.g., DiT-XL/2 --> DiT-XL-2 (for naming folders)
+            experiment_dir = f"{args.results_dir}/{experiment_index:03d}-{model_string_name}"  # Create an experiment folder
         checkpoint_dir = f"{experiment_dir}/checkpoints"  # Stores saved model checkpoints
         os.makedirs(checkpoint_dir, exist_ok=True)
         logger = create_logger(experiment_dir)
-        logger.info(f"Experiment directory created at {experiment_dir}")
+        logger.info(f"Experiment directory {'resumed' if resume_path is not None else 'created'} at {experiment_dir}")
     else:
         logger = create_logger(None)
+    # every rank writes its own checkpoint shards
+    checkpoint_dirs = [checkpoint_dir if rank == 0 else None]
+    dist.broadcast_object_list(checkpoint_dirs)
+    checkpoint_dir = checkpoint_dirs[0]
+    checkpointer = AsyncCheckpointer(checkpoint_dir, keep_last=args.keep_last_ckpts)
 
     # Create model:
     vae_stride_t, vae_stride_h, vae_stride_w = [int(i) for i in args.vae[-5:].split('x')]
@@ -130,10 +194,13 @@ def main(args):
         num_classes=args.num_classes
     )
     model.gradient_checkpointing = args.gradient_checkpointing
+    model.set_fused_adaln(args.fused_adaln)
 
 
     if args.pt_ckpt is not None:
-        state_dict = torch.load(args.pt_ckpt, map_location='cpu')
+        # a single file, or a replicated (DDP, not FSDP) checkpoint directory written by this script
+        state_dict = load_checkpoint(args.pt_ckpt, require_replicated=True) if os.path.isdir(args.pt_ckpt) \
+            else torch.load(args.pt_ckpt, map_location='cpu', weights_only=False)
         if state_dict.get('model', None) is not None:
             state_dict = state_dict['model']
         del state_dict['x_embedder.proj.weight']
@@ -143,18 +210,40 @@ def main(args):
         del state_dict['y_embedder.embedding_table.weight']
         missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
         print('missing_keys:', missing_keys, 'unexpected_keys:', unexpected_keys)
-        assert len(missing_keys) == 4
+        # factorized blocks additionally miss their (zero-initialized) temporal branch
+        assert len([k for k in missing_keys if '.temporal_' not in k and '.norm_temporal' not in k]) == 4
         logger.info(f"{missing_keys}, {unexpected_keys}")
 
     # Note that parameter initialization is done within the DiT constructor
-    ema = deepcopy(model).to(device)  # Create an EMA of the model for use after training
-    requires_grad(ema, False)
-    model = DDP(model.to(device), device_ids=[rank])
+    num_params = sum(p.numel() for p in model.parameters())
+    if args.sharding == "ddp":
+        ema = deepcopy(model).to(device if args.ema_device == "cuda" else "cpu")  # Create an EMA of the model for use after training
+        requires_grad(ema, False)
+        model = DDP(model.to(device), device_ids=[device] if use_cuda else None)
+        module = model.module
+    else:
+        # Parameters, gradients, optimizer state and the EMA are sharded over all ranks, one FSDP unit per block
+        assert args.ema_device == "cuda", "the sharded EMA stays on the training device"
+        ema = deepcopy(model)
+        requires_grad(ema, False)
+        ema = shard_model(ema, device)  # never trained, so always fully sharded
+        model = shard_model(model, device, strategy=args.sharding)
+        module = model
+    # only the training forward is compiled, module keeps serving the EMA and checkpoints
+    train_model = torch.compile(model) if args.compile else model
+    dtype = PRECISIONS[args.precision]
+    # fp16 gradients underflow without loss scaling, bf16 has the exponent range of fp32
+    if args.sharding == "ddp":
+        scaler = torch.cuda.amp.GradScaler(enabled=args.precision == "fp16")  # never enabled on the CPU
+    else:
+        scaler = ShardedGradScaler(enabled=args.precision == "fp16")
     diffusion = create_diffusion(timestep_respacing="")  # default: 1000 steps, linear noise schedule
+    schedule_sampler = create_named_schedule_sampler(args.schedule_sampler, diffusion)
     # vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-{args.vae}").to(device)
-    vae = load_vqvae(args.vae, root='./').to(device)
+    # With pre-computed latents (see extract_latents.py) the VAE encoder is never needed:
+    vae = load_vqvae(args.vae, root='./').to(device) if args.latent_path is None else None
     logger.info(f"{model}")
-    logger.info(f"DiT Parameters: {sum(p.numel() for p in model.parameters()):,}")
+    logger.info(f"DiT Parameters: {num_params:,}")
     for n, p in model.named_parameters():
         if p.requires_grad:
             logger.info(f"Training Parameters: {n}")
@@ -163,95 +252,223 @@ def main(args):
     opt = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=0)
 
     # Setup data:
-    dataset = UCF101ClassConditionedDataset(args.data_path, args.sample_rate, args.num_frames, args.max_image_size,
-                                            dynamic_frames=args.dynamic_frames)
-    sampler = DistributedSampler(
-        dataset,
-        num_replicas=dist.get_world_size(),
-        rank=rank,
-        shuffle=True,
-        seed=args.global_seed
-    )
-    loader = DataLoader(
-        dataset,
-        batch_size=int(args.global_batch_size // dist.get_world_size()),
-        shuffle=False,
-        sampler=sampler,
-        num_workers=args.num_workers,
-        pin_memory=True,
-        drop_last=True,
-        collate_fn=Collate(args.max_image_size, vae_stride_h, patch_size_h, patch_size_t, args.num_frames)
-    )
-    logger.info(f"Dataset contains {len(dataset):,} images ({args.data_path})")
+    if args.latent_path is not None:
+        dataset = LatentDataset(args.latent_path, dynamic_frames=args.dynamic_frames)
+        assert dataset.meta['vae'] == args.vae, f"Latents were extracted with {dataset.meta['vae']}, not {args.vae}."
+        collate_fn = PackedCollate(patch_size_h, patch_size_t) if args.pack_sequences \
+            else LatentCollate(patch_size_h, patch_size_t)
+    else:
+        if args.video_index is not None:
+            if rank == 0:
+                update_video_index(args.data_path, args.video_index, num_workers=args.num_workers)
+            dist.barrier()
+        dataset = UCF101ClassConditionedDataset(args.data_path, args.sample_rate, args.num_frames, args.max_image_size,
+                                                dynamic_frames=args.dynamic_frames, video_index=args.video_index)
+        collate_fn = Collate(args.max_image_size, vae_stride_h, patch_size_h, patch_size_t, args.num_frames)
+    if args.bucket_sampler:
+        # group clips by patch grid so batches carry (almost) no padding tokens
+        grid_sizes = [collate_fn.patchify_size(i) for i in dataset.get_input_sizes()]
+        sampler = DistributedBucketBatchSampler(
+            grid_sizes,
+            batch_size=int(args.global_batch_size // dist.get_world_size()),
+            num_replicas=dist.get_world_size(),
+            rank=rank,
+            shuffle=True,
+            seed=args.global_seed
+        )
+        loader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            num_workers=args.num_workers,
+            pin_memory=True,
+            collate_fn=collate_fn
+        )
+    else:
+        sampler = ResumableDistributedSampler(
+            dataset,
+            num_replicas=dist.get_world_size(),
+            rank=rank,
+            shuffle=True,
+            seed=args.global_seed
+        )
+        loader = DataLoader(
+            dataset,
+            batch_size=int(args.global_batch_size // dist.get_world_size()),
+            shuffle=False,
+            sampler=sampler,
+            num_workers=args.num_workers,
+            pin_memory=True,
+            drop_last=True,
+            collate_fn=collate_fn
+        )
+    logger.info(f"Training in {args.precision}{' with torch.compile' if args.compile else ''}")
+    logger.info(f"Dataset contains {len(dataset):,} videos ({args.latent_path or args.data_path})")
 
     # Prepare models for training:
-    update_ema(ema, model.module, decay=0)  # Ensure EMA is initialized with synced weights
+    # The EMA runs outside autocast on the fp32 master weights, so it stays in full precision
+    ema_updater = EMA(ema, module, decay=args.ema_decay, update_every=args.ema_every,
+                      warmup=None if args.ema_warmup == "none" else args.ema_warmup, side_stream=args.ema_stream)
+    ema_updater.update(decay=0)  # Ensure EMA is initialized with synced weights
     model.train()  # important! This enables embedding dropout for classifier-free guidance
     ema.eval()  # EMA model should always be in eval mode
 
     # Variables for monitoring/logging purposes:
     train_steps = 0
+    first_epoch = 0
+    epoch_step = 0  # the number of batches of the current epoch trained on
+    if resume_path is not None:
+        checkpoint = load_checkpoint(resume_path)
+        assert checkpoint["world_size"] == dist.get_world_size() and checkpoint["args"].global_batch_size == \
+            args.global_batch_size, "exact resume needs the world size and batch size of the checkpoint"
+        if args.sharding == "ddp":
+            model.module.load_state_dict(checkpoint["model"])
+            ema.load_state_dict(checkpoint["ema"])
+            opt.load_state_dict(checkpoint["opt"])
+        else:
+            load_sharded_state_dict(checkpoint, model, ema, opt)
+        scaler.load_state_dict(checkpoint["scaler"])
+        ema_updater.load_state_dict(checkpoint["ema_updater"])
+        schedule_sampler.load_state_dict(checkpoint["schedule_sampler"])
+        train_steps, first_epoch, epoch_step = checkpoint["train_steps"], checkpoint["epoch"], checkpoint["epoch_step"]
+        set_rng_state(checkpoint["rng"][rank])
+        logger.info(f"Resumed from {resume_path} at step {train_steps} (epoch {first_epoch}, batch {epoch_step})")
+        del checkpoint
     log_steps = 0
     running_loss = 0
+    running_tokens = torch.zeros((), device=device, dtype=torch.long)
     start_time = time()
 
     logger.info(f"Training for {args.epochs} epochs...")
-    for epoch in range(args.epochs):
-        sampler.set_epoch(epoch)
-        logger.info(f"Beginning epoch {epoch}...")
+    for epoch in range(first_epoch, args.epochs):
+        # when resuming mid-epoch, the sampler skips the clips already trained on without loading them
+        skip = epoch_step if args.bucket_sampler else epoch_step * loader.batch_size
+        sampler.set_epoch(epoch, start=skip)
+        logger.info(f"Beginning epoch {epoch}{f' at batch {epoch_step}' if epoch_step else ''}...")
+        if args.bucket_sampler:
+            logger.info(f"Bucket padding efficiency: {sampler.padding_efficiency():.2%}")
         for x, y, attn_mask in loader:
-            x = x.to(device)
-            y = y.to(device)
-            attn_mask = attn_mask.to(device)
-            with torch.no_grad():
-                # Map input images to latent space + normalize latents:
-                x = vae.pre_vq_conv(vae.encoder(x))
-            t = torch.randint(0, diffusion.num_timesteps, (x.shape[0],), device=device)
-            model_kwargs = dict(y=y, attention_mask=attn_mask)
-            loss_dict = diffusion.training_losses(model, x, t, model_kwargs)
-            loss = loss_dict["loss"].mean()
+            if args.pack_sequences:
+                # PackedCollate returns the packing metadata in place of the mask
+                clip_tokens = (attn_mask['cu_seqlens'][1:] - attn_mask['cu_seqlens'][:-1]).tolist()
+            else:
+                clip_tokens = [attn_mask[0].numel()] * len(y)
+            t_batch, weights = schedule_sampler.sample(len(y), device)
+            micro_batches = micro_batch_ranges(clip_tokens, args.micro_batch_tokens, args.grad_accum_steps)
+            if args.micro_batch_tokens is not None:
+                # every rank runs the same number of forward/backward passes, FSDP gathers parameters in each
+                num_micro_batches = torch.tensor(len(micro_batches), device=device)
+                dist.all_reduce(num_micro_batches, op=dist.ReduceOp.MAX)
+                micro_batches = split_micro_batches(micro_batches, num_micro_batches.item())
+
             opt.zero_grad()
+            loss = 0
+            batch_losses = []
+            for i, (start, end) in enumerate(micro_batches):
+                # gradients are only all-reduced in the backward of the last micro-batch
+                with model.no_sync() if i < len(micro_batches) - 1 else nullcontext():
+                    t_clip = t_batch[start:end]
+                    if args.pack_sequences:
+                        # every token is a diffusion sample, carrying the timestep of its clip
+                        packing = slice_packing(attn_mask, start, end)
+                        x_micro = x[attn_mask['cu_seqlens'][start]:attn_mask['cu_seqlens'][end]].to(device)
+                        packing = {k: v.to(device) if torch.is_tensor(v) else v for k, v in packing.items()}
+                        t = t_clip[packing['seq_ids']]
+                        model_kwargs = dict(y=y[start:end].to(device), packing=packing)
+                        running_tokens += packing['seq_ids'].numel()
+                    else:
+                        x_micro = x[start:end].to(device)
+                        t = t_clip
+                        model_kwargs = dict(y=y[start:end].to(device), attention_mask=attn_mask[start:end].to(device))
+                        running_tokens += model_kwargs['attention_mask'].sum().long()
+                    if vae is not None:
+                        with torch.no_grad(), \
+                                torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype != torch.float32):
+                            # Map input images to latent space + normalize latents:
+                            x_micro = vae.pre_vq_conv(vae.encoder(x_micro)).float()
+                    loss_dict = diffusion.training_losses(autocast_forward(train_model, dtype, device_type), x_micro, t,
+                                                          model_kwargs)
+                    losses = packed_clip_mean(loss_dict["loss"], packing) if args.pack_sequences else loss_dict["loss"]
+                    # each micro-batch adds its share of the mean over the whole batch, however uneven the split
+                    micro_loss = (losses * weights[start:end]).sum() / len(y)
+                    scaler.scale(micro_loss).backward()
+                batch_losses.append(losses.detach())
+                loss += micro_loss.detach()
+            if isinstance(schedule_sampler, LossAwareSampler):
+                schedule_sampler.update_with_local_losses(t_batch, torch.cat(batch_losses))
 
-            loss.backward()
             if args.clip_grad_norm is not None:
-                nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad_norm)
-            opt.step()
+                scaler.unscale_(opt)
+                if args.sharding == "ddp":
+                    nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad_norm)
+                else:
+                    model.clip_grad_norm_(args.clip_grad_norm)  # the norm over the shards of all ranks
+            ema_updater.wait()  # the EMA may still read the parameters on its side stream
+            scaler.step(opt)
+            scaler.update()
 
-            update_ema(ema, model.module)
+            ema_updater.step()
 
             # Log loss values:
             running_loss += loss.item()
             log_steps += 1
             train_steps += 1
+            epoch_step += 1
             if train_steps % args.log_every == 0:
                 # Measure training speed:
-                torch.cuda.synchronize()
+                if use_cuda:
+                    torch.cuda.synchronize()
                 end_time = time()
                 steps_per_sec = log_steps / (end_time - start_time)
                 # Reduce loss history over all processes:
                 avg_loss = torch.tensor(running_loss / log_steps, device=device)
                 dist.all_reduce(avg_loss, op=dist.ReduceOp.SUM)
                 avg_loss = avg_loss.item() / dist.get_world_size()
-                logger.info(f"(step={train_steps:07d}) Train Loss: {avg_loss:.4f}, Train Steps/Sec: {steps_per_sec:.2f}")
+                # Tokens are summed over all processes, peak memory is the maximum of any process:
+                dist.all_reduce(running_tokens, op=dist.ReduceOp.SUM)
+                tokens_per_sec = running_tokens.item() / (end_time - start_time)
+                peak_mem = torch.tensor(torch.cuda.max_memory_allocated(device) if use_cuda else 0, device=device)
+                dist.all_reduce(peak_mem, op=dist.ReduceOp.MAX)
+                logger.info(f"(step={train_steps:07d}) Train Loss: {avg_loss:.4f}, Train Steps/Sec: {steps_per_sec:.2f}, "
+                            f"Tokens/Sec: {tokens_per_sec:,.0f}, Peak Memory: {peak_mem.item() / 2 ** 30:.2f} GiB")
                 # Reset monitoring variables:
                 running_loss = 0
+                running_tokens.zero_()
+                if use_cuda:
+                    torch.cuda.reset_peak_memory_stats(device)
                 log_steps = 0
                 start_time = time()
 
             # Save DiT checkpoint:
             if train_steps % args.ckpt_every == 0 and train_steps > 0:
-                if rank == 0:
+                ema_updater.wait()
+                if args.sharding == "ddp":
                     checkpoint = {
                         "model": model.module.state_dict(),
                         "ema": ema.state_dict(),
                         "opt": opt.state_dict(),
-                        "args": args
                     }
-                    checkpoint_path = f"{checkpoint_dir}/{train_steps:07d}.pt"
-                    torch.save(checkpoint, checkpoint_path)
-                    logger.info(f"Saved checkpoint to {checkpoint_path}")
-                dist.barrier()
-
+                else:
+                    checkpoint = sharded_state_dict(model, ema, opt)
+                # every rank's RNGs, so the resumed run continues each random stream exactly
+                rng_states = [None] * dist.get_world_size()
+                dist.all_gather_object(rng_states, rng_state())
+                checkpoint.update(
+                    scaler=scaler.state_dict(),
+                    ema_updater=ema_updater.state_dict(),
+                    schedule_sampler=schedule_sampler.state_dict(),
+                    train_steps=train_steps,
+                    epoch=epoch,
+                    epoch_step=epoch_step,
+                    world_size=dist.get_world_size(),
+                    rng=rng_states,
+                    args=args
+                )
+                # snapshots to pinned memory and writes in the background, every rank writes one shard
+                checkpointer.save(train_steps, checkpoint, replicated=args.sharding == "ddp")
+                logger.info(f"Saving checkpoint to {checkpoint_dir}/{train_steps:07d}")
+        epoch_step = 0
+
+    checkpointer.close()
     model.eval()  # important! This disables randomized embedding dropout
     # do any sampling/FID calculation/etc. with ema (or model) in eval mode ...
 
@@ -262,7 +479,11 @@ def main(args):
 if __name__ == "__main__":
     # Default args here will train DiT-XL/2 with the hyperparameters we used in our paper (except training iters).
     parser = argparse.ArgumentParser()
-    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--data-path", type=str, default=None)
+    parser.add_argument("--latent-path", type=str, default=None,
+                        help="train on latents pre-computed by extract_latents.py instead of encoding --data-path")
+    parser.add_argument("--video-index", type=str, default=None,
+                        help="persistent metadata index of --data-path, created on first use and refreshed incrementally")
     parser.add_argument("--results-dir", type=str, default="results")
     parser.add_argument("--model", type=str, choices=list(DiT_models.keys()), default="DiT-XL/122")
     parser.add_argument("--num-classes", type=int, default=1000)
@@ -272,6 +493,9 @@ if __name__ == "__main__":
     parser.add_argument("--num-workers", type=int, default=8)
     parser.add_argument("--log-every", type=int, default=100)
     parser.add_argument("--ckpt-every", type=int, default=50_000)
+    parser.add_argument("--resume", type=str, default=None,
+                        help="checkpoint to resume from exactly, or a checkpoints folder to resume from its newest one")
+    parser.add_argument("--keep-last-ckpts", type=int, default=None, help="delete all but the newest N checkpoints")
 
 
     # --------------------------------------
@@ -283,11 +507,38 @@ if __name__ == "__main__":
     parser.add_argument("--num-frames", type=int, default=16)
     parser.add_argument("--max-image-size", type=int, default=128)
     parser.add_argument("--dynamic-frames", action="store_true")
+    parser.add_argument("--bucket-sampler", action="store_true",
+                        help="batch clips of equal patch grid together, needs --video-index or --latent-path")
+    parser.add_argument("--pack-sequences", action="store_true",
+                        help="pack the clips of a batch into one token sequence instead of padding, needs --latent-path")
+    parser.add_argument("--schedule-sampler", type=str, choices=["uniform", "loss-second-moment"], default="uniform",
+                        help="how training timesteps are drawn, loss-second-moment importance-samples them")
+    parser.add_argument("--sharding", type=str, choices=["ddp"] + list(SHARDING_STRATEGIES.keys()), default="ddp",
+                        help="zero2/zero3 shard gradients and optimizer state (and zero3 parameters) with FSDP")
     parser.add_argument("--gradient-checkpointing", action="store_true")
+    parser.add_argument("--fused-adaln", action="store_true", help="use the fused adaLN norm/modulate/gate path")
+    parser.add_argument("--precision", type=str, choices=list(PRECISIONS.keys()), default="fp32",
+                        help="autocast dtype of the DiT and VAE forward, the weights and optimizer stay fp32")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the DiT for training")
+    parser.add_argument("--ema-decay", type=float, default=0.9999)
+    parser.add_argument("--ema-every", type=int, default=1,
+                        help="update the EMA every k steps, with the decay corrected for the skipped steps")
+    parser.add_argument("--ema-warmup", type=str, choices=["none", "linear", "power"], default="none")
+    parser.add_argument("--ema-device", type=str, choices=["cuda", "cpu"], default="cuda",
+                        help="keep the EMA on the training device (the GPU) or in host memory")
+    parser.add_argument("--ema-stream", action="store_true", help="update the EMA on a separate CUDA stream")
+    parser.add_argument("--grad-accum-steps", type=int, default=1,
+                        help="split every batch into at least this many micro-batches and accumulate their gradients")
+    parser.add_argument("--micro-batch-tokens", type=int, default=None,
+                        help="split batches into micro-batches of at most this many tokens, so long clips fit in memory")
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--clip-grad-norm", default=None, type=float, help="the maximum gradient norm (default None)")
     # --------------------------------------
 
 
     args = parser.parse_args()
+    assert (args.data_path is None) != (args.latent_path is None), "Pass exactly one of --data-path and --latent-path."
+    assert not args.bucket_sampler or args.latent_path is not None or args.video_index is not None, \
+        "--bucket-sampler needs the clip sizes from --video-index or --latent-path."
+    assert not args.pack_sequences or args.latent_path is not None, "--pack-sequences needs --latent-path."
     main(args)
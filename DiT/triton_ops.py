@@ -0,0 +1,97 @@
+"""
+Triton kernels of DiT, currently the fused adaLN norm/modulate step of the blocks.
+
+layer_norm_modulate() computes LayerNorm(x) * (1 + scale) + shift (a LayerNorm
+without affine parameters) in one pass over every token: one read of x, shift
+and scale, one write of the output, and no (B, N, D) intermediates. The backward
+recomputes the normalized input from the saved per-token mean and rstd.
+Only available with triton on CUDA tensors, see models.fused_layer_norm_modulate()
+for the PyTorch fallback.
+"""
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+MAX_FUSED_DIM = 16384
+
+
+if triton is not None:
+    @triton.jit
+    def _layer_norm_modulate_kernel(X, SHIFT, SCALE, Y, MEAN, RSTD, N, D,
+                                    stride_shift_b, stride_shift_n, stride_scale_b, stride_scale_n, eps,
+                                    BLOCK_D: tl.constexpr):
+        # one program per token: row = b * N + n
+        row = tl.program_id(0)
+        cols = tl.arange(0, BLOCK_D)
+        valid = cols < D
+        x = tl.load(X + row * D + cols, mask=valid, other=0.).to(tl.float32)
+        mean = tl.sum(x, axis=0) / D
+        xc = tl.where(valid, x - mean, 0.)
+        rstd = 1 / tl.sqrt(tl.sum(xc * xc, axis=0) / D + eps)
+        b = row // N
+        n = row % N
+        shift = tl.load(SHIFT + b * stride_shift_b + n * stride_shift_n + cols, mask=valid, other=0.).to(tl.float32)
+        scale = tl.load(SCALE + b * stride_scale_b + n * stride_scale_n + cols, mask=valid, other=0.).to(tl.float32)
+        tl.store(Y + row * D + cols, xc * rstd * (1 + scale) + shift, mask=valid)
+        tl.store(MEAN + row, mean)
+        tl.store(RSTD + row, rstd)
+
+
+class _LayerNormModulate(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, x, shift, scale, eps):
+        B, N, D = x.shape
+        x = x.contiguous()
+        out_dtype = torch.promote_types(torch.promote_types(x.dtype, shift.dtype), scale.dtype)
+        y = torch.empty(B, N, D, device=x.device, dtype=out_dtype)
+        mean = torch.empty(B * N, device=x.device, dtype=torch.float32)
+        rstd = torch.empty_like(mean)
+        # (B, 1, D) per-sample or (1, N, D) per-token modulation, the last dim must be dense
+        shift_b = shift.expand(B, N, D) if shift.stride(-1) == 1 else shift.contiguous().expand(B, N, D)
+        scale_b = scale.expand(B, N, D) if scale.stride(-1) == 1 else scale.contiguous().expand(B, N, D)
+        _layer_norm_modulate_kernel[(B * N,)](
+            x, shift_b, scale_b, y, mean, rstd, N, D,
+            shift_b.stride(0), shift_b.stride(1), scale_b.stride(0), scale_b.stride(1), eps,
+            BLOCK_D=triton.next_power_of_2(D),
+        )
+        ctx.save_for_backward(x, scale, mean, rstd)
+        ctx.shift_shape, ctx.shift_dtype = shift.shape, shift.dtype
+        return y
+
+    @staticmethod
+    def backward(ctx, dy):
+        x, scale, mean, rstd = ctx.saved_tensors
+        B, N, D = x.shape
+        mean, rstd = mean.view(B, N, 1), rstd.view(B, N, 1)
+        x_hat = (x.float() - mean) * rstd
+        dy = dy.float()
+        d_shift = dy.sum_to_size(ctx.shift_shape).to(ctx.shift_dtype)
+        d_scale = (dy * x_hat).sum_to_size(scale.shape).to(scale.dtype)
+        dx_hat = dy * (1 + scale.float())
+        dx = rstd * (dx_hat - dx_hat.mean(-1, keepdim=True) - x_hat * (dx_hat * x_hat).mean(-1, keepdim=True))
+        return dx.to(x.dtype), d_shift, d_scale, None
+
+
+def can_fuse(x):
+    """
+    Whether layer_norm_modulate() supports x, a (B, N, D) tensor. Not while torch.compile traces,
+    which generates its own fused kernel for the PyTorch fallback.
+    """
+    compiler = getattr(torch, "compiler", None)
+    if compiler is not None and compiler.is_compiling():
+        return False
+    return triton is not None and x.is_cuda and x.ndim == 3 and x.shape[-1] <= MAX_FUSED_DIM
+
+
+def layer_norm_modulate(x, shift, scale, eps):
+    """
+    LayerNorm(x) * (1 + scale) + shift in a single Triton kernel.
+    x: (B, N, D) tensor
+    shift, scale: (B, 1, D) or (1, N, D) tensors, e.g. from models.expand_modulation()
+    """
+    return _LayerNormModulate.apply(x, shift, scale, eps)
@@ -1,10 +1,14 @@
+import json
 import math
 import os
+from multiprocessing import Pool
 
 import numpy as np
 import torch
+from einops import rearrange
 from decord import VideoReader, cpu
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
 from torchvision.transforms import Compose, Lambda, ToTensor
 from torchvision.transforms._transforms_video import NormalizeVideo, RandomCropVideo, RandomHorizontalFlipVideo
 from pytorchvideo.transforms import ApplyTransformToKey, ShortSideScale, UniformTemporalSubsample
@@ -41,13 +45,99 @@ class LongSideScale(torch.nn.Module):
             new_h = int(math.floor((float(h) / w) * self._size))
         return torch.nn.functional.interpolate(x, size=(new_h, new_w), mode=self._interpolation, align_corners=False)
 
+def _probe_video(video_path):
+    try:
+        decord_vr = VideoReader(video_path, ctx=cpu(0))
+        height, width = decord_vr[0].shape[:2]
+        return len(decord_vr), decord_vr.get_avg_fps(), height, width
+    except Exception as e:
+        print(f'Error with {e}, {video_path}')
+        return None
+
+
+def update_video_index(root_dir, index_path, num_workers=8):
+    """
+    Create or refresh the persistent video index of a UCF101-style root_dir (one sub-folder per class).
+    Only videos that are new or whose size/mtime changed since the last update are probed with decord,
+    unchanged entries are copied over from the existing index. The index is written atomically.
+    :param num_workers: the number of processes probing videos, 0 probes them in this process.
+    :return: the index, as returned by load_video_index().
+    """
+    old = load_video_index(index_path) if os.path.exists(index_path) else None
+    old_rows = {} if old is None else {p: i for i, p in enumerate(old['path'])}
+
+    classes = sorted(os.listdir(root_dir))
+    rows, to_probe = [], []
+    for label, class_name in enumerate(classes):
+        with os.scandir(os.path.join(root_dir, class_name)) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                if not entry.name.endswith('.avi'):
+                    continue
+                rel_path = f'{class_name}/{entry.name}'
+                st = entry.stat()
+                i = old_rows.get(rel_path)
+                if i is not None and old['size'][i] == st.st_size and old['mtime'][i] == st.st_mtime:
+                    probe = (old['num_frames'][i], old['fps'][i], old['height'][i], old['width'][i])
+                else:
+                    probe = None
+                    to_probe.append(len(rows))
+                rows.append([rel_path, label, probe, st.st_size, st.st_mtime])
+
+    if len(to_probe) > 0:
+        print(f'Probing {len(to_probe)} new or changed videos under {root_dir}')
+        paths = [os.path.join(root_dir, rows[i][0]) for i in to_probe]
+        if num_workers > 0:
+            with Pool(num_workers) as pool:
+                probes = pool.map(_probe_video, paths, chunksize=16)
+        else:
+            probes = list(map(_probe_video, paths))
+        for i, probe in zip(to_probe, probes):
+            rows[i][2] = probe
+    rows = [r for r in rows if r[2] is not None]  # drop videos decord cannot open
+
+    index = {
+        'classes': np.array(classes),
+        'path': np.array([r[0] for r in rows]),
+        'label': np.array([r[1] for r in rows], dtype=np.int32),
+        'num_frames': np.array([r[2][0] for r in rows], dtype=np.int64),
+        'fps': np.array([r[2][1] for r in rows], dtype=np.float32),
+        'height': np.array([r[2][2] for r in rows], dtype=np.int32),
+        'width': np.array([r[2][3] for r in rows], dtype=np.int32),
+        'size': np.array([r[3] for r in rows], dtype=np.int64),
+        'mtime': np.array([r[4] for r in rows], dtype=np.float64),
+    }
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **index)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def load_video_index(index_path):
+    """
+    Load a video index written by update_video_index() into a dict of numpy arrays:
+    classes, and per video its path (relative to root_dir), label, num_frames, fps, height, width, size and mtime.
+    """
+    with np.load(index_path) as f:
+        return {k: f[k] for k in f.files}
+
+
 class UCF101ClassConditionedDataset(Dataset):
-    def __init__(self, root_dir, sample_rate, num_frames, max_image_size, dynamic_frames=False):
+    def __init__(self, root_dir, sample_rate, num_frames, max_image_size, dynamic_frames=False, video_index=None):
         self.root_dir = root_dir
 
-        self.classes = sorted(os.listdir(root_dir))
-        self.class_to_idx = {cls_name: idx for idx, cls_name in enumerate(self.classes)}
-        self.samples = self._make_dataset()
+        if video_index is not None:
+            # all per-video metadata comes from the persistent index, no directory walk or header probing
+            self.video_index = load_video_index(video_index)
+            self.classes = self.video_index['classes'].tolist()
+            self.class_to_idx = {cls_name: idx for idx, cls_name in enumerate(self.classes)}
+            self.samples = [(os.path.join(root_dir, p), int(l))
+                            for p, l in zip(self.video_index['path'], self.video_index['label'])]
+        else:
+            self.video_index = None
+            self.classes = sorted(os.listdir(root_dir))
+            self.class_to_idx = {cls_name: idx for idx, cls_name in enumerate(self.classes)}
+            self.samples = self._make_dataset()
 
         self.sample_rate = sample_rate
         self.num_frames = num_frames
@@ -79,7 +169,8 @@ class UCF101ClassConditionedDataset(Dataset):
         video_path, label = self.samples[idx]
 
         try:
-            video_data = self.read_video(video_path)
+            total_frames = None if self.video_index is None else int(self.video_index['num_frames'][idx])
+            video_data = self.read_video(video_path, total_frames)
             video_outputs = self.transform(video_data)
             # video_outputs = torch.rand(3, 16, 128, 128)
             return video_outputs, label
@@ -88,10 +179,14 @@ class UCF101ClassConditionedDataset(Dataset):
             return self.__getitem__(random.randint(0, self.__len__()-1))
 
 
-    def read_video(self, video_path):
+    def read_video(self, video_path, total_frames=None):
         decord_vr = VideoReader(video_path, ctx=cpu(0))
+        if total_frames is None:
+            total_frames = len(decord_vr)
+        frame_id_list = self.get_frame_ids(total_frames, video_path)
+        return self.read_frames(decord_vr, frame_id_list)
 
-        total_frames = len(decord_vr)
+    def get_frame_ids(self, total_frames, video_path=''):
         if total_frames > self.sample_frames_len:
             s = random.randint(0, total_frames - self.sample_frames_len - 1)
             e = s + self.sample_frames_len
@@ -107,12 +202,28 @@ class UCF101ClassConditionedDataset(Dataset):
         if self.dynamic_frames and total_frames > self.sample_frames_len:  # actually only second-half is dynamic, because num_frames are rare...
             cut_idx = random.randint(num_frames // 2, num_frames)
             frame_id_list = frame_id_list[:cut_idx]
+        return frame_id_list
 
+    def read_frames(self, decord_vr, frame_id_list):
         video_data = decord_vr.get_batch(frame_id_list).asnumpy()
         video_data = torch.from_numpy(video_data)
         video_data = video_data.permute(3, 0, 1, 2)  # (T, H, W, C) -> (C, T, H, W)
         return video_data
 
+    def get_input_sizes(self):
+        """
+        (T, H, W) of every clip after read_video and the transform, derived from the video index without decoding.
+        With dynamic_frames, T is the longest a clip can be.
+        """
+        assert self.video_index is not None, "Input sizes are only known with a video_index."
+        total_frames = self.video_index['num_frames']
+        t = np.where(total_frames > self.sample_frames_len, self.num_frames,
+                     (total_frames / self.sample_frames_len * self.num_frames).astype(np.int64))
+        h, w = self.video_index['height'], self.video_index['width']
+        new_h = np.where(w < h, self.max_image_size, np.floor(h / w * self.max_image_size)).astype(np.int64)
+        new_w = np.where(w < h, np.floor(w / h * self.max_image_size), self.max_image_size).astype(np.int64)
+        return np.stack([t, new_h, new_w], axis=1)
+
 def pad_to_multiple(number, ds_stride):
     remainder = number % ds_stride
     if remainder == 0:
@@ -129,6 +240,13 @@ class Collate:
         self.patch_size_t = patch_size_t
         self.num_frames = num_frames
 
+    def patchify_size(self, input_size):
+        ds_stride = self.vae_stride * self.patch_size
+        t_ds_stride = self.vae_stride * self.patch_size_t
+        return [int(math.ceil(input_size[0] / t_ds_stride)),
+                int(math.ceil(input_size[1] / ds_stride)),
+                int(math.ceil(input_size[2] / ds_stride))]
+
     def __call__(self, batch):
         batch_tubes, labels = tuple(zip(*batch))
         labels = torch.as_tensor(labels).to(torch.long)
@@ -160,9 +278,7 @@ class Collate:
         max_patchify_latent_size = [max_latent_size[0] // self.patch_size_t,
                                     max_latent_size[1] // self.patch_size,
                                     max_latent_size[2] // self.patch_size]
-        valid_patchify_latent_size = [[int(math.ceil(i[1] / t_ds_stride)),
-                                       int(math.ceil(i[2] / ds_stride)),
-                                       int(math.ceil(i[3] / ds_stride))] for i in batch_input_size]
+        valid_patchify_latent_size = [self.patchify_size(i[1:]) for i in batch_input_size]
         attention_mask = [F.pad(torch.ones(i),
                                 (0, max_patchify_latent_size[2] - i[2],
                                  0, max_patchify_latent_size[1] - i[1],
@@ -172,3 +288,280 @@ class Collate:
         return pad_batch_tubes, labels, attention_mask
 
 
+# Row layout of the clip index written by extract_latents.py. Latents are stored as raw
+# (C, latent_t, latent_h, latent_w) arrays in latents_{rank:03d}_{shard:04d}.bin starting at `offset` elements;
+# valid_* are the un-padded latent extents and frame_* the decoded frame window the clip was sampled from.
+LATENT_INDEX_DTYPE = np.dtype([
+    ('video_idx', np.int64), ('clip_idx', np.int32), ('label', np.int32),
+    ('rank', np.int32), ('shard', np.int32), ('offset', np.int64),
+    ('latent_t', np.int32), ('latent_h', np.int32), ('latent_w', np.int32),
+    ('valid_t', np.int32), ('valid_h', np.int32), ('valid_w', np.int32),
+    ('frame_start', np.int64), ('frame_end', np.int64), ('num_frames', np.int32),
+])
+
+
+def latent_shard_path(latent_path, rank, shard):
+    return os.path.join(latent_path, f'latents_{rank:03d}_{shard:04d}.bin')
+
+
+class LatentDataset(Dataset):
+    """
+    Reads VQ-VAE latents pre-computed by extract_latents.py from memory-mapped shards.
+    Each item is one randomly chosen stored clip of a video, so extracting several clips
+    per video keeps the temporal jitter of UCF101ClassConditionedDataset.
+    """
+    def __init__(self, latent_path, dynamic_frames=False):
+        self.latent_path = latent_path
+        with open(os.path.join(latent_path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.classes = self.meta['classes']
+        self.channels = self.meta['channels']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.dynamic_frames = dynamic_frames
+
+        index = np.concatenate([np.load(os.path.join(latent_path, f'index_{rank:03d}.npy'))
+                                for rank in range(self.meta['world_size'])])
+        self.index = index[np.lexsort((index['clip_idx'], index['video_idx']))]
+        # clips of the i-th video are self.index[self.video_start[i]:self.video_start[i + 1]]
+        _, video_start = np.unique(self.index['video_idx'], return_index=True)
+        self.video_start = np.append(video_start, len(self.index))
+        self._shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}  # memmaps are re-opened lazily in every worker
+        return state
+
+    def __len__(self):
+        return len(self.video_start) - 1
+
+    def _get_shard(self, rank, shard):
+        key = (rank, shard)
+        if key not in self._shards:
+            self._shards[key] = np.memmap(latent_shard_path(self.latent_path, rank, shard), dtype=self.dtype, mode='r')
+        return self._shards[key]
+
+    def __getitem__(self, idx):
+        row = self.index[random.randint(self.video_start[idx], self.video_start[idx + 1] - 1)]
+        shape = (self.channels, int(row['latent_t']), int(row['latent_h']), int(row['latent_w']))
+        offset, numel = int(row['offset']), int(np.prod(shape))
+        latent = self._get_shard(int(row['rank']), int(row['shard']))[offset:offset + numel]
+        latent = torch.from_numpy(latent.reshape(shape).astype(np.float32))
+        valid_size = [int(row['valid_t']), int(row['valid_h']), int(row['valid_w'])]
+
+        # random drop to dynamic input frames, in latent space
+        if self.dynamic_frames and row['num_frames'] == self.meta['num_frames']:
+            cut_idx = random.randint(int(math.ceil(valid_size[0] / 2)), valid_size[0])
+            latent = latent[:, :cut_idx]
+            valid_size[0] = cut_idx
+        return latent, int(row['label']), valid_size
+
+    def get_input_sizes(self):
+        """
+        Valid latent (t, h, w) of the first stored clip of every video.
+        """
+        first = self.index[self.video_start[:-1]]
+        return np.stack([first['valid_t'], first['valid_h'], first['valid_w']], axis=1).astype(np.int64)
+
+
+class LatentCollate:
+    def __init__(self, patch_size, patch_size_t):
+        self.patch_size = patch_size
+        self.patch_size_t = patch_size_t
+
+    def patchify_size(self, latent_size):
+        return [int(math.ceil(latent_size[0] / self.patch_size_t)),
+                int(math.ceil(latent_size[1] / self.patch_size)),
+                int(math.ceil(latent_size[2] / self.patch_size))]
+
+    def __call__(self, batch):
+        batch_latents, labels, valid_sizes = tuple(zip(*batch))
+        labels = torch.as_tensor(labels).to(torch.long)
+
+        # pad to max multiple of patch size
+        pad_max_t = pad_to_multiple(max([i.shape[1] for i in batch_latents]), self.patch_size_t)
+        pad_max_h = pad_to_multiple(max([i.shape[2] for i in batch_latents]), self.patch_size)
+        pad_max_w = pad_to_multiple(max([i.shape[3] for i in batch_latents]), self.patch_size)
+        pad_batch_latents = [F.pad(z,
+                                   (0, pad_max_w - z.shape[3],
+                                    0, pad_max_h - z.shape[2],
+                                    0, pad_max_t - z.shape[1]), value=0) for z in batch_latents]
+        pad_batch_latents = torch.stack(pad_batch_latents, dim=0)
+
+        # make attention_mask
+        max_patchify_latent_size = [pad_max_t // self.patch_size_t,
+                                    pad_max_h // self.patch_size,
+                                    pad_max_w // self.patch_size]
+        valid_patchify_latent_size = [self.patchify_size(i) for i in valid_sizes]
+        attention_mask = [F.pad(torch.ones(i),
+                                (0, max_patchify_latent_size[2] - i[2],
+                                 0, max_patchify_latent_size[1] - i[1],
+                                 0, max_patchify_latent_size[0] - i[0]), value=0) for i in valid_patchify_latent_size]
+        attention_mask = torch.stack(attention_mask)
+
+        return pad_batch_latents, labels, attention_mask
+
+
+class PackedCollate:
+    """
+    Packs the latents of a batch (from LatentDataset) into one token sequence instead of padding them.
+    Every clip becomes t * h * w tokens of in_channels * patch_size_t * patch_size ** 2 values in DiT
+    token order, and the returned packing dict holds what DiT.forward_packed needs for block-diagonal
+    attention and per-clip adaLN conditioning: the clip of every token (seq_ids), cu_seqlens-style
+    token offsets of the clips and their (t, h, w) patch grids.
+    """
+    def __init__(self, patch_size, patch_size_t):
+        self.patch_size = patch_size
+        self.patch_size_t = patch_size_t
+
+    def patchify_size(self, latent_size):
+        # the patch grid of a clip, used by DistributedBucketBatchSampler to batch equal grids together
+        return [int(math.ceil(latent_size[0] / self.patch_size_t)),
+                int(math.ceil(latent_size[1] / self.patch_size)),
+                int(math.ceil(latent_size[2] / self.patch_size))]
+
+    def __call__(self, batch):
+        batch_latents, labels, _ = tuple(zip(*batch))
+        labels = torch.as_tensor(labels).to(torch.long)
+
+        tokens, grid_sizes = [], []
+        for z in batch_latents:
+            # only pad to whole patches, every token holds at least one valid latent
+            z = F.pad(z,
+                      (0, pad_to_multiple(z.shape[3], self.patch_size) - z.shape[3],
+                       0, pad_to_multiple(z.shape[2], self.patch_size) - z.shape[2],
+                       0, pad_to_multiple(z.shape[1], self.patch_size_t) - z.shape[1]), value=0)
+            tokens.append(rearrange(z, 'c (t o) (h p) (w q) -> (t h w) (c o p q)',
+                                    o=self.patch_size_t, p=self.patch_size, q=self.patch_size))
+            grid_sizes.append([z.shape[1] // self.patch_size_t,
+                               z.shape[2] // self.patch_size,
+                               z.shape[3] // self.patch_size])
+
+        seqlens = torch.tensor([len(i) for i in tokens])
+        packing = dict(
+            seq_ids=torch.repeat_interleave(torch.arange(len(tokens)), seqlens),
+            cu_seqlens=F.pad(seqlens.cumsum(0), (1, 0)).to(torch.int32),
+            grid_sizes=grid_sizes,
+        )
+        return torch.cat(tokens), labels, packing
+
+
+def slice_packing(packing, start, end):
+    """
+    The packing metadata of clips start:end of a PackedCollate batch, whose tokens are
+    tokens[packing['cu_seqlens'][start]:packing['cu_seqlens'][end]].
+    """
+    cu_seqlens = packing['cu_seqlens']
+    return dict(
+        seq_ids=packing['seq_ids'][cu_seqlens[start]:cu_seqlens[end]] - start,
+        cu_seqlens=cu_seqlens[start:end + 1] - cu_seqlens[start],
+        grid_sizes=packing['grid_sizes'][start:end],
+    )
+
+
+class DistributedBucketBatchSampler(Sampler):
+    """
+    Batch sampler that only puts clips with the same (t, h, w) patch grid into a batch, so Collate adds no padding.
+    Like DistributedSampler, the order is reshuffled from seed + epoch (call set_epoch) and every rank gets an
+    equally long, disjoint share of the batches. Clips left over by their bucket are pooled, sorted by size and
+    batched together, which is the only place padding can still appear.
+    :param grid_sizes: the (t, h, w) patch grid of every dataset index, e.g. from collate.patchify_size
+                       applied to dataset.get_input_sizes().
+    :param batch_size: the per-rank batch size.
+    """
+    def __init__(self, grid_sizes, batch_size, num_replicas, rank, shuffle=True, seed=0, drop_last=True):
+        self.grid_sizes = [tuple(int(i) for i in size) for size in grid_sizes]
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.start = 0
+
+        num_batches = len(self._make_batches())
+        if self.drop_last:
+            self.num_batches_per_rank = num_batches // self.num_replicas
+        else:
+            self.num_batches_per_rank = int(math.ceil(num_batches / self.num_replicas))
+
+    def set_epoch(self, epoch, start=0):
+        """
+        :param start: the number of this epoch's batches to skip, e.g. when resuming mid-epoch.
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def _make_batches(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.grid_sizes), generator=g).tolist()
+        else:
+            indices = list(range(len(self.grid_sizes)))
+
+        buckets = {}
+        for idx in indices:
+            buckets.setdefault(self.grid_sizes[idx], []).append(idx)
+        batches, leftovers = [], []
+        for key in sorted(buckets):
+            bucket = buckets[key]
+            num_full = len(bucket) // self.batch_size * self.batch_size
+            batches += [bucket[i:i + self.batch_size] for i in range(0, num_full, self.batch_size)]
+            leftovers += bucket[num_full:]
+        leftovers.sort(key=lambda idx: self.grid_sizes[idx])
+        batches += [leftovers[i:i + self.batch_size] for i in range(0, len(leftovers), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        return batches
+
+    def _rank_batches(self, batches):
+        total = self.num_batches_per_rank * self.num_replicas
+        if total > len(batches):  # pad like DistributedSampler so every rank runs the same number of steps
+            batches = batches + batches[:total - len(batches)]
+        return batches[self.rank:total:self.num_replicas]
+
+    def padding_efficiency(self):
+        """
+        Fraction of the tokens in this epoch's padded batches (over all ranks) that belong to a clip.
+        """
+        batches = self._make_batches()[:self.num_batches_per_rank * self.num_replicas]
+        valid, padded = 0, 0
+        for batch in batches:
+            sizes = np.array([self.grid_sizes[idx] for idx in batch])
+            valid += int(np.prod(sizes, axis=1).sum())
+            padded += len(batch) * int(np.prod(sizes.max(axis=0)))
+        return valid / max(padded, 1)
+
+    def __iter__(self):
+        return iter(self._rank_batches(self._make_batches())[self.start:])
+
+    def __len__(self):
+        return max(self.num_batches_per_rank - self.start, 0)
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """
+    DistributedSampler that can skip the start of an epoch, so resuming mid-epoch does not load the clips
+    that were already trained on.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """
+        :param start: the number of this epoch's (per-rank) samples to skip.
+        """
+        super().set_epoch(epoch)
+        self.start = start
+
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start, 0)